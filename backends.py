@@ -0,0 +1,475 @@
+import json
+import threading
+import time
+from collections import namedtuple
+
+from openai_client import APIError, DeferredOpenAI, RateLimitError, RetryableAPIError
+
+# the OpenAI API through the openai SDK, any OpenAI-compatible server such as
+# a self-hosted model, and deterministic answers made up in-process
+BACKENDS = ("openai", "http", "stub")
+# how many connections to an HTTP backend are kept open, shared by all threads
+POOL_SIZE = 10
+# seconds before a call to an HTTP backend is given up on, unless the call says otherwise
+REQUEST_TIMEOUT = 60
+# questions containing one of these words are flagged as violence by the stub
+FLAGGED_WORDS = ("kill", "attack")
+MODERATION_CATEGORIES = (
+    "hate", "hate/threatening", "self-harm", "sexual", "sexual/minors", "violence", "violence/graphic",
+)
+
+Completion = namedtuple("Completion", ["text", "finish_reason", "usage"])
+
+# marks the end of a streamed response
+_DONE = object()
+# what reading a response that isn't the JSON we expect raises, such as an
+# error page from a proxy sent with status 200
+_MALFORMED = (ValueError, KeyError, IndexError, TypeError, AttributeError)
+
+
+class Backend:
+    """Where chat completions and moderation results come from
+
+    Every backend has the same calls, so the bot doesn't depend on any one
+    API. Failed calls raise openai_client.APIError, or RetryableAPIError
+    when retrying is worthwhile.
+
+    Each call has an async counterpart for server.py, prefixed with "a";
+    unless a backend has its own, it runs the blocking call on a worker
+    thread.
+    """
+
+    def complete(self, messages, **params):
+        """Return the Completion of a list of messages
+
+        Args:
+            messages: The messages to send
+            **params: The model parameters, such as model and max_tokens, and
+                request_timeout in seconds
+        """
+        raise NotImplementedError
+
+    def stream(self, messages, **params):
+        """Start a streamed completion
+
+        The request is made before this returns, so a scheduler can retry
+        it; only the pieces are read later.
+
+        Takes the same arguments as complete.
+
+        Returns:
+            An iterator of (content, finish_reason) tuples; the finish reason
+            is None until the last one
+        """
+        raise NotImplementedError
+
+    def moderate(self, text, request_timeout=None):
+        """Return the moderation result of a text, a dict with "flagged" and "categories" keys
+
+        Args:
+            text: The text to moderate
+            request_timeout: Seconds before the call is given up on, or None
+                for the backend's default
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    async def acomplete(self, messages, **params):
+        """Async version of complete"""
+        import asyncio
+        return await asyncio.to_thread(self.complete, messages, **params)
+
+    async def astream(self, messages, **params):
+        """Async version of stream, returning an async iterator"""
+        import asyncio
+        pieces = await asyncio.to_thread(self.stream, messages, **params)
+        return _iterate_in_thread(pieces)
+
+    async def amoderate(self, text, request_timeout=None):
+        """Async version of moderate"""
+        import asyncio
+        return await asyncio.to_thread(self.moderate, text, request_timeout)
+
+    async def aclose(self):
+        self.close()
+
+
+class OpenAIBackend(Backend):
+    """The OpenAI API, through the openai SDK imported on first use"""
+
+    def __init__(self, api_key=None, api_base=None):
+        self.client = DeferredOpenAI(api_key=api_key, api_base=api_base)
+
+    def complete(self, messages, **params):
+        completion = self.client.chat_completion(messages=messages, **params)
+        choice = completion.choices[0]
+        return Completion(choice.message.content, choice.finish_reason, dict(completion.usage))
+
+    def stream(self, messages, **params):
+        return self._pieces(self.client.chat_completion(messages=messages, stream=True, **params))
+
+    def _pieces(self, chunks):
+        for chunk in chunks:
+            choice = chunk.choices[0]
+            content = choice.delta.get("content")
+            if content or choice.get("finish_reason"):
+                yield content or "", choice.get("finish_reason")
+
+    def moderate(self, text, request_timeout=None):
+        # openai.Moderation.create takes no timeout, unlike ChatCompletion.create
+        return self.client.moderation(input=text).results[0]
+
+
+class HTTPBackend(Backend):
+    """Any server with OpenAI-compatible /chat/completions and /moderations
+
+    Connections are pooled and shared by every thread. requests is imported
+    on the first call, like the openai SDK. The async calls use an aiohttp
+    session of their own, with its own pool, bound to the event loop of the
+    first async call.
+    """
+
+    def __init__(self, api_base, api_key=None, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+        """
+        Args:
+            api_base: The URL the endpoints are under, such as http://localhost:8000/v1
+            api_key: Sent as a bearer token, if given
+            pool_size: How many connections are kept open
+            timeout: Seconds before a call is given up on, unless the call says otherwise
+        """
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._async_session = None
+        self._lock = threading.Lock()
+
+    def session(self):
+        """Return the requests session, creating it on first use"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    if self.api_key:
+                        session.headers["Authorization"] = f"Bearer {self.api_key}"
+                    self._session = session
+        return self._session
+
+    def _post(self, path, payload, timeout=None, stream=False):
+        session = self.session()
+        import requests
+        try:
+            response = session.post(
+                self.api_base + path, json=payload, timeout=timeout or self.timeout, stream=stream
+            )
+        except requests.RequestException as error:
+            raise RetryableAPIError(str(error)) from error
+        if response.status_code >= 400:
+            try:
+                message = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = response.text
+            response.close()
+            raise _status_error(response.status_code, message, response.headers)
+        return response
+
+    def complete(self, messages, request_timeout=None, **params):
+        response = self._post(
+            "/chat/completions", {"messages": messages, "stream": False, **params}, timeout=request_timeout
+        )
+        try:
+            return _completion(response.json())
+        except _MALFORMED as error:
+            raise _malformed(error) from error
+
+    def stream(self, messages, request_timeout=None, **params):
+        response = self._post(
+            "/chat/completions", {"messages": messages, "stream": True, **params}, timeout=request_timeout, stream=True
+        )
+        return self._pieces(response)
+
+    def _pieces(self, response):
+        import requests
+        # the body is a stream of server-sent events, one chunk per event
+        try:
+            with response:
+                for line in response.iter_lines():
+                    piece = _event_piece(line)
+                    if piece is _DONE:
+                        return
+                    if piece is not None:
+                        yield piece
+        except requests.RequestException as error:
+            raise RetryableAPIError(str(error)) from error
+
+    def moderate(self, text, request_timeout=None):
+        response = self._post("/moderations", {"input": text}, timeout=request_timeout)
+        try:
+            return response.json()["results"][0]
+        except _MALFORMED as error:
+            raise _malformed(error) from error
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    def async_session(self):
+        """Return the aiohttp session, creating it on first use"""
+        if self._async_session is None:
+            import aiohttp
+            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+            self._async_session = aiohttp.ClientSession(
+                headers=headers, connector=aiohttp.TCPConnector(limit=self.pool_size)
+            )
+        return self._async_session
+
+    async def _apost(self, path, payload, timeout=None):
+        session = self.async_session()
+        import aiohttp
+        import asyncio
+        try:
+            response = await session.post(
+                self.api_base + path, json=payload, timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise RetryableAPIError(str(error) or type(error).__name__) from error
+        if response.status >= 400:
+            try:
+                message = (await response.json(content_type=None))["error"]["message"]
+            except (ValueError, KeyError, TypeError, aiohttp.ClientError):
+                message = await response.text()
+            response.release()
+            raise _status_error(response.status, message, response.headers)
+        return response
+
+    async def _aread(self, response):
+        import aiohttp
+        import asyncio
+        try:
+            return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise RetryableAPIError(str(error) or type(error).__name__) from error
+        except ValueError as error:
+            raise _malformed(error) from error
+        finally:
+            response.release()
+
+    async def acomplete(self, messages, request_timeout=None, **params):
+        response = await self._apost(
+            "/chat/completions", {"messages": messages, "stream": False, **params}, timeout=request_timeout
+        )
+        completion = await self._aread(response)
+        try:
+            return _completion(completion)
+        except _MALFORMED as error:
+            raise _malformed(error) from error
+
+    async def astream(self, messages, request_timeout=None, **params):
+        response = await self._apost(
+            "/chat/completions", {"messages": messages, "stream": True, **params}, timeout=request_timeout
+        )
+        return self._apieces(response)
+
+    async def _apieces(self, response):
+        import aiohttp
+        import asyncio
+        try:
+            async for line in response.content:
+                piece = _event_piece(line.strip())
+                if piece is _DONE:
+                    return
+                if piece is not None:
+                    yield piece
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise RetryableAPIError(str(error) or type(error).__name__) from error
+        finally:
+            # give the connection back now if the answer was cut off
+            response.release()
+
+    async def amoderate(self, text, request_timeout=None):
+        response = await self._apost("/moderations", {"input": text}, timeout=request_timeout)
+        result = await self._aread(response)
+        try:
+            return result["results"][0]
+        except _MALFORMED as error:
+            raise _malformed(error) from error
+
+    async def aclose(self):
+        self.close()
+        if self._async_session is not None:
+            await self._async_session.close()
+
+
+class StubBackend(Backend):
+    """Deterministic answers made up in-process, without a network
+
+    Answers repeat the question, like fake_openai.py's; max_tokens is
+    counted in words, and questions containing one of FLAGGED_WORDS are
+    flagged as violence.
+    """
+
+    def __init__(self, latency=0, answer_words=0):
+        """
+        Args:
+            latency: Seconds each call takes
+            answer_words: Words the answers are padded to, for realistic token counts
+        """
+        self.latency = latency
+        self.answer_words = answer_words
+
+    def complete(self, messages, request_timeout=None, **params):
+        time.sleep(self.latency)
+        text, finish_reason = stub_answer(messages, params.get("max_tokens"), self.answer_words)
+        return Completion(text, finish_reason, stub_usage(messages, text))
+
+    def stream(self, messages, request_timeout=None, **params):
+        time.sleep(self.latency)
+        return iter(self._pieces(messages, params))
+
+    def _pieces(self, messages, params):
+        text, finish_reason = stub_answer(messages, params.get("max_tokens"), self.answer_words)
+        words = text.split(" ")
+        pieces = [(word if i == len(words) - 1 else word + " ", None) for i, word in enumerate(words)]
+        return pieces + [("", finish_reason)]
+
+    def moderate(self, text, request_timeout=None):
+        time.sleep(self.latency)
+        return stub_moderation(text)
+
+    async def acomplete(self, messages, request_timeout=None, **params):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        text, finish_reason = stub_answer(messages, params.get("max_tokens"), self.answer_words)
+        return Completion(text, finish_reason, stub_usage(messages, text))
+
+    async def astream(self, messages, request_timeout=None, **params):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        return _iterate(self._pieces(messages, params))
+
+    async def amoderate(self, text, request_timeout=None):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        return stub_moderation(text)
+
+
+def _event_piece(line):
+    """Return the (content, finish_reason) of a line of a server-sent event stream
+
+    Returns:
+        The piece, None for lines without one, or _DONE at the end of the stream
+    """
+    if not line.startswith(b"data:"):
+        return None
+    data = line[len(b"data:"):].strip()
+    if data == b"[DONE]":
+        return _DONE
+    try:
+        choice = json.loads(data)["choices"][0]
+        content = choice["delta"].get("content")
+    except _MALFORMED as error:
+        raise _malformed(error) from error
+    if content or choice.get("finish_reason"):
+        return content or "", choice.get("finish_reason")
+    return None
+
+
+def _completion(body):
+    """Turn the JSON of a /chat/completions response into a Completion"""
+    choice = body["choices"][0]
+    return Completion(choice["message"]["content"], choice.get("finish_reason"), body["usage"])
+
+
+def _malformed(error):
+    return APIError(f"the API sent a response that couldn't be read: {type(error).__name__}: {error}")
+
+
+def _status_error(status, message, headers):
+    if status == 429:
+        return RateLimitError(f"{status}: {message}", dict(headers))
+    # timeouts and server errors are worth retrying too
+    error = RetryableAPIError if status >= 500 else APIError
+    return error(f"{status}: {message}", dict(headers))
+
+
+async def _iterate(pieces):
+    for piece in pieces:
+        yield piece
+
+
+async def _iterate_in_thread(pieces):
+    import asyncio
+    while (piece := await asyncio.to_thread(next, pieces, _DONE)) is not _DONE:
+        yield piece
+
+
+def stub_answer(messages, max_tokens=None, words=0):
+    """Make up a deterministic answer to the last message
+
+    Args:
+        messages: The messages of the request
+        max_tokens: The most words the answer may have, or None
+        words: Words the answer is padded to
+
+    Returns:
+        A tuple of the answer and its finish reason
+    """
+    answer = f"You asked: {messages[-1]['content']}"
+    padding = max(0, words - len(answer.split()))
+    answer = " ".join([answer] + ["lorem"] * padding)
+    # a word stands in for a token
+    parts = answer.split(" ")
+    if max_tokens and len(parts) > max_tokens:
+        return " ".join(parts[:max_tokens]), "length"
+    return answer, "stop"
+
+
+def stub_usage(messages, answer):
+    """Count the words of a request and its answer as tokens"""
+    prompt_tokens = sum(len(message["content"].split()) for message in messages)
+    completion_tokens = len(answer.split())
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def stub_moderation(text):
+    """Return the moderation result the stub gives a text"""
+    flagged = any(word in text.lower() for word in FLAGGED_WORDS)
+    return {
+        "flagged": flagged,
+        "categories": {category: flagged and category == "violence" for category in MODERATION_CATEGORIES},
+    }
+
+
+def create_backend(name, api_base=None, api_key=None, pool_size=POOL_SIZE):
+    """Create a backend by name
+
+    Args:
+        name: One of BACKENDS
+        api_base: The URL of the API; required for "http", and by default the
+            SDK's for "openai"
+        api_key: The API key, by default the SDK's for "openai"
+        pool_size: How many connections an "http" backend keeps open
+
+    Returns:
+        The Backend
+    """
+    if name == "openai":
+        return OpenAIBackend(api_key=api_key, api_base=api_base)
+    if name == "http":
+        if not api_base:
+            raise ValueError("the http backend needs the URL of the server")
+        return HTTPBackend(api_base, api_key=api_key, pool_size=pool_size)
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"unknown backend {name!r}, expected one of {', '.join(BACKENDS)}")
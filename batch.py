@@ -0,0 +1,125 @@
+"""Answer questions from a JSONL file without the interactive loop
+
+Each input line is a JSON object with the question in "question" (or
+"body", as in requests.jsonl) and an id in "request_id" or "id"; lines
+without an id are numbered. An optional "history" holds earlier
+[question, answer] pairs of the conversation, and an optional "profile"
+names the prompt profile to answer with when PROFILES_PATH is set.
+
+Results are appended to the output file as they finish, one JSON object
+per line, so an interrupted run picks up where it stopped when started
+again with the same output file.
+
+    python batch.py requests.jsonl answers.jsonl --concurrency 8
+"""
+import argparse
+import json
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from main import INSTRUCTIONS, get_moderation, get_profile, get_response
+
+# how many questions are answered at the same time; main.scheduler keeps
+# the calls within the account's rate limits and retries failed ones
+CONCURRENCY = 4
+
+
+def read_requests(path):
+    """Yield (request_id, record) for each line of a JSONL file
+
+    The file is read one line at a time, so it can be larger than memory.
+    """
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            request_id = record.get("request_id", record.get("id", f"line-{number}"))
+            yield str(request_id), record
+
+
+def read_done(path):
+    """Return the ids that already have a result in an output file"""
+    done = set()
+    try:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut short by a crash
+                    continue
+                if "error" not in result:
+                    done.add(result["request_id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def answer(request_id, record, instructions=INSTRUCTIONS):
+    """Moderate and answer one question
+
+    Returns:
+        The result to write to the output file
+    """
+    question = record.get("question") or record.get("body") or ""
+    history = [tuple(pair) for pair in record.get("history", [])]
+    result = {"request_id": request_id, "question": question}
+    try:
+        errors = get_moderation(question)
+        if errors:
+            result["moderation_errors"] = errors
+        else:
+            profile = get_profile(record.get("profile"))
+            if profile is not None:
+                result["answer"] = get_response(
+                    profile.instructions, history, question, profile.knowledge_base, profile
+                )
+            else:
+                result["answer"] = get_response(instructions, history, question)
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    return result
+
+
+def run(input_path, output_path, concurrency=CONCURRENCY, instructions=INSTRUCTIONS):
+    """Answer every question in the input file that has no result yet
+
+    At most `concurrency` questions are in flight, and only those are held in
+    memory.
+
+    Returns:
+        The number of questions answered in this run
+    """
+    done = read_done(output_path)
+    count = 0
+    lock = threading.Lock()
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(concurrency) as executor:
+
+        def write(future):
+            nonlocal count
+            with lock:
+                output.write(json.dumps(future.result()) + "\n")
+                output.flush()
+                count += 1
+
+        pending = set()
+        for request_id, record in read_requests(input_path):
+            if request_id in done:
+                continue
+            if len(pending) >= concurrency:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = executor.submit(answer, request_id, record, instructions)
+            future.add_done_callback(write)
+            pending.add(future)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file to append the results to")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+    count = run(args.input, args.output, args.concurrency)
+    print(f"Answered {count} questions")
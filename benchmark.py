@@ -0,0 +1,344 @@
+"""Measure the bot's latency and throughput against a local fake API
+
+Starts fake_openai.py in a background thread, points the bot at it and
+drives each code path at several concurrency levels:
+
+    moderation  main.get_moderation
+    response    main.get_response
+    turn        main.get_moderated_response, reading streamed answers to the end
+    server      POST /sessions/{id}/messages of server.py
+    batch       batch.run over a generated input file
+
+Every question is new, so the exact caches always miss, and the semantic
+cache is turned off; the rate limits are lifted so they don't set the pace.
+
+Each run reports p50/p95/p99 latency, requests per second, errors and the
+peak memory of the process, and appends the results to a JSONL file. A
+result is compared with the last one for the same scenario, concurrency
+and fake API settings, and the script exits with status 1 if latency or
+throughput got more than REGRESSION_TOLERANCE worse.
+
+    python benchmark.py --scenarios turn,server --concurrency 1,8,32 --latency 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+import batch
+import fake_openai
+import main
+import server
+from backends import HTTPBackend, create_backend
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SCENARIOS = ("moderation", "response", "turn", "server", "batch")
+CONCURRENCY_LEVELS = (1, 8, 32)
+# how many questions each scenario asks at each concurrency level
+REQUESTS = 100
+RESULTS_PATH = "benchmark_results.jsonl"
+# how much worse p95 latency or requests per second may get before it counts as a regression
+REGRESSION_TOLERANCE = 0.1
+
+# every question asked during a run is different
+_question_numbers = itertools.count()
+
+
+def new_question():
+    return f"Benchmark question {next(_question_numbers)}: where is my order?"
+
+
+class FakeServer:
+    """Runs fake_openai in a background thread for the length of a with block
+
+    Attributes:
+        url: The base URL of the fake API, such as http://localhost:41234/v1
+    """
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.url = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._runner = None
+
+    async def _start(self):
+        self._runner = web.AppRunner(fake_openai.create_app(self.behaviour))
+        await self._runner.setup()
+        # port 0 lets the OS pick a free port
+        site = web.TCPSite(self._runner, "localhost", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def _read(response):
+    """Read a response to the end, whether it is text or streamed"""
+    return response if isinstance(response, str) else "".join(response)
+
+
+def _ask_moderation(question):
+    return main.get_moderation(question)
+
+
+def _ask_response(question):
+    return main.get_response(main.INSTRUCTIONS, [], question)
+
+
+def _ask_turn(question):
+    errors, response = main.get_moderated_response(main.INSTRUCTIONS, [], question)
+    return errors or _read(response)
+
+
+def run_threaded(ask, requests, concurrency):
+    """Ask `requests` questions from `concurrency` threads
+
+    Returns:
+        A tuple of the latencies of the successful requests and the number of errors
+    """
+    latencies = []
+    failures = []
+
+    def timed(question):
+        start = time.perf_counter()
+        try:
+            ask(question)
+        except main.API_ERRORS as error:
+            failures.append(error)
+            return
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(timed, [new_question() for _ in range(requests)]))
+    return latencies, len(failures)
+
+
+async def _run_server(api_base, requests, concurrency):
+    backend = HTTPBackend(api_base, api_key="benchmark", pool_size=concurrency)
+    runner = web.AppRunner(server.create_app(backend))
+    await runner.setup()
+    site = web.TCPSite(runner, "localhost", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    latencies = []
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def post(session, number):
+        nonlocal errors
+        async with limit:
+            start = time.perf_counter()
+            # one session per question, so the session locks don't serialize them
+            url = f"http://{host}:{port}/sessions/benchmark-{number}/messages"
+            async with session.post(url, json={"question": new_question()}) as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+                    return
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(post(session, number) for number in range(requests)))
+    finally:
+        await runner.cleanup()
+    return latencies, errors
+
+
+def run_server(api_base, requests, concurrency):
+    """Post `requests` questions to server.py, `concurrency` at a time"""
+    return asyncio.run(_run_server(api_base, requests, concurrency))
+
+
+def run_batch(requests, concurrency):
+    """Answer a file of `requests` questions with batch.run"""
+    latencies = []
+    failures = []
+    answer = batch.answer
+
+    def timed(request_id, record, instructions):
+        start = time.perf_counter()
+        result = answer(request_id, record, instructions)
+        if "error" in result:
+            failures.append(result["error"])
+        else:
+            latencies.append(time.perf_counter() - start)
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, "questions.jsonl")
+        with open(input_path, "w", encoding="utf-8") as file:
+            for number in range(requests):
+                file.write(json.dumps({"id": number, "question": new_question()}) + "\n")
+        # time each question as batch.run answers it
+        batch.answer = timed
+        try:
+            batch.run(input_path, os.path.join(directory, "answers.jsonl"), concurrency)
+        finally:
+            batch.answer = answer
+    return latencies, len(failures)
+
+
+def max_rss_mb():
+    """Return the peak resident memory of the process so far, in MB, if known"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(scenario, concurrency, latencies, errors, seconds):
+    """Turn the measurements of one run into a result record"""
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 2),
+        "max_rss_mb": max_rss_mb(),
+    }
+    for percentile in (50, 95, 99):
+        value = np.percentile(latencies, percentile) if latencies else None
+        result[f"p{percentile}"] = None if value is None else round(float(value), 4)
+    return result
+
+
+def read_results(path):
+    try:
+        with open(path, encoding="utf-8") as file:
+            return [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def find_regressions(result, previous, tolerance=REGRESSION_TOLERANCE):
+    """Compare a result with the last comparable one
+
+    Returns:
+        A list of messages, empty if nothing got worse by more than `tolerance`
+    """
+    baseline = None
+    for record in reversed(previous):
+        if all(record.get(key) == result[key] for key in ("scenario", "concurrency", "requests", "fake")):
+            baseline = record
+            break
+    if baseline is None:
+        return []
+    regressions = []
+    if baseline["p95"] and result["p95"] and result["p95"] > baseline["p95"] * (1 + tolerance):
+        regressions.append(f"p95 {baseline['p95']}s -> {result['p95']}s")
+    if baseline["rps"] and result["rps"] < baseline["rps"] * (1 - tolerance):
+        regressions.append(f"rps {baseline['rps']} -> {result['rps']}")
+    return regressions
+
+
+def run(scenarios, concurrency_levels, requests, behaviour, results_path=RESULTS_PATH):
+    """Run every scenario at every concurrency level and store the results
+
+    Returns:
+        The number of results that regressed
+    """
+    # measure the API calls themselves, not the caches or the rate limits
+    main.SEMANTIC_CACHE_THRESHOLD = None
+    main.scheduler.requests = None
+    main.scheduler.tokens = None
+    # failed requests are counted, so the server needn't log each one
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    previous = read_results(results_path)
+    commit = git_commit()
+    fake = {
+        "latency": behaviour.latency,
+        "jitter": behaviour.jitter,
+        "error_rate": behaviour.error_rate,
+        "tokens_per_second": behaviour.tokens_per_second,
+        "answer_words": behaviour.answer_words,
+    }
+    regressed = 0
+    print(f"{'scenario':<12}{'conc':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'rps':>9}{'errors':>8}{'rss MB':>9}")
+    with FakeServer(behaviour) as fake_server, open(results_path, "a", encoding="utf-8") as output:
+        # the deployment's backend, pointed at the fake API
+        main.backend = main.moderation_backend = create_backend(
+            main.LLM_BACKEND,
+            api_base=fake_server.url,
+            api_key=os.getenv("OPENAI_API_KEY") or "benchmark",
+            pool_size=max(concurrency_levels),
+        )
+        for scenario in scenarios:
+            for concurrency in concurrency_levels:
+                start = time.perf_counter()
+                if scenario == "server":
+                    latencies, errors = run_server(fake_server.url, requests, concurrency)
+                elif scenario == "batch":
+                    latencies, errors = run_batch(requests, concurrency)
+                else:
+                    ask = {"moderation": _ask_moderation, "response": _ask_response, "turn": _ask_turn}[scenario]
+                    latencies, errors = run_threaded(ask, requests, concurrency)
+                result = summarize(scenario, concurrency, latencies, errors, time.perf_counter() - start)
+                result.update(time=time.time(), commit=commit, fake=fake)
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+                regressions = find_regressions(result, previous)
+                regressed += bool(regressions)
+                print(
+                    f"{scenario:<12}{concurrency:>6}"
+                    + "".join(f"{result[key] if result[key] is not None else '-':>9}" for key in ("p50", "p95", "p99", "rps"))
+                    + f"{errors:>8}{result['max_rss_mb'] or '-':>9}"
+                    + (f"  REGRESSION: {', '.join(regressions)}" if regressions else "")
+                )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default=",".join(map(str, CONCURRENCY_LEVELS)), help="comma separated levels")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="questions per scenario and level")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL file to append the results to")
+    fake_openai.add_arguments(parser)
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario!r}")
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    regressed = run(scenarios, concurrency_levels, args.requests, fake_openai.behaviour_from_args(args), args.results)
+    sys.exit(1 if regressed else 0)
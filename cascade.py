@@ -0,0 +1,211 @@
+import re
+
+# answers that start like this mean the model couldn't or wouldn't answer
+REFUSAL_PATTERNS = [
+    r"(i'm|i am) sorry, (but )?i (can't|cannot|don't|do not|am unable|'m unable)",
+    r"as an ai( language model)?\b",
+    r"i (can't|cannot|am unable to|'m unable to) (help|assist|answer|provide)",
+    r"i (don't|do not) (know|have (enough )?information)",
+    r"i'm not sure\b",
+]
+# how many characters at the start of an answer are checked for a refusal
+REFUSAL_WINDOW = 80
+# asks the next model to carry on from an answer the previous one cut short
+CONTINUE_PROMPT = "Continue your answer from exactly where it stopped."
+
+
+class Cascade:
+    """Picks which model tier answers a question
+
+    Tiers are tried cheapest first. An answer is escalated to the next tier
+    if it is a refusal or was cut short by max_tokens; a question that is a
+    poor match for the knowledge base starts one tier up, since the cheap
+    tier has little to go on.
+    """
+
+    def __init__(self, tiers, refusal_patterns=REFUSAL_PATTERNS, min_retrieval_score=None):
+        """
+        Args:
+            tiers: Dicts of completion parameters, such as "model" and
+                "max_tokens", that override the defaults, cheapest first
+            refusal_patterns: Regular expressions matching refusals
+            min_retrieval_score: Questions whose best knowledge base match
+                scores lower skip the first tier, or None to never skip it
+        """
+        self.tiers = list(tiers) or [{}]
+        self.refusal = re.compile("|".join(f"(?:{pattern})" for pattern in refusal_patterns))
+        self.min_retrieval_score = min_retrieval_score
+
+    def __len__(self):
+        return len(self.tiers)
+
+    def first_tier(self, retrieval_score=None):
+        """Return the tier to start at and, if it isn't the first, why"""
+        if (
+            len(self.tiers) > 1
+            and retrieval_score is not None
+            and self.min_retrieval_score is not None
+            and retrieval_score < self.min_retrieval_score
+        ):
+            return 1, "retrieval"
+        return 0, None
+
+    def is_last(self, tier):
+        return tier >= len(self.tiers) - 1
+
+    def is_refusal(self, text):
+        return self.refusal.search(text[:REFUSAL_WINDOW].lower().replace("’", "'")) is not None
+
+    def escalation_reason(self, tier, text, finish_reason):
+        """Return why an answer should go to the next tier, or None to keep it"""
+        if self.is_last(tier):
+            return None
+        if finish_reason == "length":
+            return "length"
+        if self.is_refusal(text):
+            return "refusal"
+        return None
+
+
+class CascadeRun:
+    """Works through the tiers of a Cascade for one answer
+
+    The caller sends `request` with the current tier's `params` and hands
+    the answer over, streamed piece by piece to feed and then end_attempt,
+    or whole to answered. The run decides what to show, whether to go to
+    the next tier and what to ask it, until it is `done`.
+
+    The start of a streamed answer that could still be escalated is held
+    back until REFUSAL_WINDOW characters show it isn't a refusal, and a
+    streamed answer cut short by max_tokens is finished by the next tier
+    rather than asked again. The on_ methods are called along the way and
+    do nothing; subclasses override them to record metrics.
+
+    Attributes:
+        tier: The tier answering now
+        request: The messages to send to it
+        pieces: The text shown so far
+        stopped: Whether the streamed answer is a refusal and needn't be read further
+        done: Whether the answer is final
+    """
+
+    def __init__(self, cascade, messages, tier=0):
+        """
+        Args:
+            cascade: The Cascade of the request
+            messages: The messages of the request
+            tier: The tier to start at, such as Cascade.first_tier picks
+        """
+        self.cascade = cascade
+        self.messages = messages
+        self.tier = tier
+        self.request = messages
+        self.pieces = []
+        self.done = False
+        self._start_attempt()
+
+    @property
+    def params(self):
+        """The parameters of the current tier, overriding the defaults"""
+        return self.cascade.tiers[self.tier]
+
+    @property
+    def answer(self):
+        return "".join(self.pieces)
+
+    def feed(self, content, finish_reason=None):
+        """Take the next piece of the current tier's streamed answer
+
+        Returns:
+            The text to show now, or None
+        """
+        self.finish_reason = finish_reason or self.finish_reason
+        if not content:
+            return None
+        self._attempt.append(content)
+        if self._held:
+            content = "".join(self._attempt)
+            if len(content) < REFUSAL_WINDOW:
+                return None
+            if self.cascade.is_refusal(content):
+                self.stopped = True
+                return None
+            self._held = False
+        return self._show(content)
+
+    def end_attempt(self):
+        """Finish the current tier's streamed answer and decide what comes next
+
+        Returns:
+            The text still to show, or None
+        """
+        content = "".join(self._attempt)
+        self.on_attempt(self.request, content)
+        shown = None
+        reason = None
+        if self._held:
+            # the answer was stopped, or ended, before it was let through
+            if self.cascade.is_refusal(content):
+                reason = "refusal"
+            elif content:
+                shown = self._show(content)
+        if reason is None:
+            reason = self.cascade.escalation_reason(self.tier, self.answer, self.finish_reason)
+        self._next(reason)
+        return shown
+
+    def answered(self, text, finish_reason, usage=None):
+        """Take the current tier's whole answer and decide what comes next
+
+        An answer that falls short is asked again of the next tier in full.
+
+        Args:
+            text: The answer
+            finish_reason: Why the answer ended
+            usage: The token counts the API gave for it, if any
+        """
+        self.on_attempt(self.request, text, usage)
+        reason = self.cascade.escalation_reason(self.tier, text, finish_reason)
+        if reason is None:
+            self.pieces = [text]
+        self._next(reason, continue_answer=False)
+
+    def on_first_piece(self):
+        """Called when the first text of a streamed answer is let through"""
+
+    def on_attempt(self, request, text, usage=None):
+        """Called with the request and answer of each tier that was tried"""
+
+    def on_escalation(self, reason):
+        """Called after moving up a tier, with why"""
+
+    def on_done(self):
+        """Called once the answer is final"""
+
+    def _start_attempt(self):
+        self._attempt = []
+        self.finish_reason = None
+        self.stopped = False
+        # only the start of an answer can be a refusal
+        self._held = not self.pieces and not self.cascade.is_last(self.tier)
+
+    def _show(self, content):
+        if not self.pieces:
+            self.on_first_piece()
+        self.pieces.append(content)
+        return content
+
+    def _next(self, reason, continue_answer=True):
+        if reason is None:
+            self.done = True
+            self.on_done()
+            return
+        self.tier += 1
+        self.on_escalation(reason)
+        if reason == "length" and continue_answer:
+            # the answer so far has been shown, so the next tier finishes it
+            self.request = self.messages + [
+                {"role": "assistant", "content": self.answer},
+                {"role": "user", "content": CONTINUE_PROMPT},
+            ]
+        self._start_attempt()
@@ -0,0 +1,162 @@
+"""A local stand-in for the OpenAI chat completion and moderation endpoints
+
+Answers are deterministic, so the server and the bot can be exercised
+without an API key or network access:
+
+    python fake_openai.py --port 8081 --latency 0.3 --tokens-per-second 50
+    OPENAI_API_BASE=http://localhost:8081/v1 python server.py
+
+Questions containing one of backends.FLAGGED_WORDS are flagged as violence by the
+moderation endpoint. Answers longer than max_tokens words are cut short
+with a "length" finish reason. Latency, error rate and token rate can be
+set to mimic the real API under load.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+from backends import stub_answer, stub_moderation, stub_usage
+
+
+class Behaviour:
+    """How the fake endpoints respond
+
+    Attributes:
+        latency: Seconds before each response starts
+        jitter: Up to this many seconds are added to the latency at random
+        error_rate: Fraction of requests answered with a 429 or a 500
+        tokens_per_second: How fast answers are generated, or None for instantly
+        answer_words: Words the answer is padded to, for realistic token counts
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, tokens_per_second=None, answer_words=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.answer_words = answer_words
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    async def wait(self):
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+    def error(self):
+        """Return an error response for a share of requests, or None"""
+        self.requests += 1
+        if self.random.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        if self.random.random() < 0.5:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={"Retry-After": "0"},
+            )
+        return web.json_response(
+            {"error": {"message": "The server had an error", "type": "server_error"}}, status=500
+        )
+
+
+async def chat_completions(request):
+    behaviour = request.app["behaviour"]
+    body = await request.json()
+    await behaviour.wait()
+    error = behaviour.error()
+    if error is not None:
+        return error
+    answer, finish_reason = stub_answer(body["messages"], body.get("max_tokens"), behaviour.answer_words)
+    words = answer.split(" ")
+    completion_id = f"chatcmpl-{time.time_ns()}"
+    if not body.get("stream"):
+        if behaviour.tokens_per_second:
+            await asyncio.sleep(len(words) / behaviour.tokens_per_second)
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": finish_reason,
+            }],
+            "usage": stub_usage(body["messages"], answer),
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    async def send(delta, finish_reason=None):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+    await send({"role": "assistant"})
+    for i, word in enumerate(words):
+        if behaviour.tokens_per_second:
+            await asyncio.sleep(1 / behaviour.tokens_per_second)
+        await send({"content": word if i == len(words) - 1 else word + " "})
+    await send({}, finish_reason)
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def moderations(request):
+    behaviour = request.app["behaviour"]
+    body = await request.json()
+    await behaviour.wait()
+    error = behaviour.error()
+    if error is not None:
+        return error
+    return web.json_response({
+        "id": f"modr-{time.time_ns()}",
+        "model": "text-moderation-latest",
+        "results": [stub_moderation(body["input"])],
+    })
+
+
+def create_app(behaviour=None):
+    app = web.Application()
+    app["behaviour"] = behaviour or Behaviour()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/moderations", moderations)
+    return app
+
+
+def add_arguments(parser):
+    """Add the options that set the Behaviour to an argument parser"""
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each response starts")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument("--tokens-per-second", type=float, help="how fast answers are generated")
+    parser.add_argument("--answer-words", type=int, default=0, help="pad answers to this many words")
+
+
+def behaviour_from_args(args):
+    return Behaviour(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        tokens_per_second=args.tokens_per_second,
+        answer_words=args.answer_words,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(create_app(behaviour_from_args(args)), host=args.host, port=args.port)
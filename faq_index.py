@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+from text import NGRAM_RANGE, char_ngrams, normalize
+
+# compiled index files start with these bytes
+MAGIC = b"FAQIDX\0\0"
+FORMAT_VERSION = 1
+# byte boundary the arrays in a compiled index start on
+ALIGNMENT = 64
+
+
+class FaqIndex:
+    """TF-IDF index over character n-grams of the FAQ questions
+
+    The vectors are L2-normalized rows of a NumPy matrix, so a single
+    matrix-vector product gives the cosine similarity of a new question
+    against every stored question.
+    """
+
+    def __init__(self, questions, answers, ngram_range=NGRAM_RANGE):
+        """Build the index
+
+        Args:
+            questions: The FAQ questions
+            answers: The FAQ answers, in the same order as the questions
+            ngram_range: The smallest and largest character n-gram size
+        """
+        self.questions = list(questions)
+        self.answers = list(answers)
+        self.ngram_range = ngram_range
+        self.source_digest = None
+        grams = [char_ngrams(normalize(q), ngram_range) for q in self.questions]
+        # assign a column to every n-gram we have seen
+        self.vocabulary = {}
+        for doc in grams:
+            for gram in doc:
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+        counts = np.zeros((len(grams), len(self.vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(grams):
+            for gram in doc:
+                counts[row, self.vocabulary[gram]] += 1
+        # smoothed inverse document frequency, as in scikit-learn
+        df = np.count_nonzero(counts, axis=0)
+        self.idf = (np.log((1 + len(grams)) / (1 + df)) + 1).astype(np.float32)
+        self.matrix = self._normalize_rows(counts * self.idf)
+
+    @classmethod
+    def from_pairs(cls, pairs, **kwargs):
+        """Build an index from (question, answer) pairs"""
+        questions = [question for question, _ in pairs]
+        answers = [answer for _, answer in pairs]
+        return cls(questions, answers, **kwargs)
+
+    def __len__(self):
+        return len(self.questions)
+
+    @staticmethod
+    def _normalize_rows(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def vectorize(self, text):
+        """Turn text into a unit TF-IDF vector in the index's vocabulary
+
+        n-grams that never occur in the FAQ are ignored.
+        """
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for gram in char_ngrams(normalize(text), self.ngram_range):
+            column = self.vocabulary.get(gram)
+            if column is not None:
+                vector[column] += 1
+        return self._normalize_rows(vector * self.idf)
+
+    def search(self, question, k=1):
+        """Find the stored questions most similar to a question
+
+        Args:
+            question: The question to look up
+            k: How many results to return
+
+        Returns:
+            A list of (row, score) tuples, best match first
+        """
+        if not len(self):
+            return []
+        scores = self.matrix @ self.vectorize(question)
+        k = min(k, len(scores))
+        # argpartition avoids sorting the whole score vector
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    def match(self, question, threshold):
+        """Return the stored answer if a question is close enough to an FAQ
+
+        Args:
+            question: The question to look up
+            threshold: The minimum cosine similarity for a match
+
+        Returns:
+            The stored answer, or None if nothing is similar enough
+        """
+        results = self.search(question, k=1)
+        if results and results[0][1] >= threshold:
+            return self.answers[results[0][0]]
+        return None
+
+    def save(self, path, source_digest=None):
+        """Write the index to a binary file that load can memory-map
+
+        The file starts with MAGIC and the length of a JSON header holding the
+        texts and the vocabulary, followed by the IDF vector and the matrix
+        as float32, each aligned to ALIGNMENT bytes.
+
+        The file is written next to `path` and renamed over it, so processes
+        that have the old index memory-mapped keep reading the old file
+        rather than crashing on one that changes under them.
+
+        Args:
+            path: The file to write
+            source_digest: Digest of the knowledge base file the index was built from
+        """
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "source_digest": source_digest,
+            "ngram_range": list(self.ngram_range),
+            "shape": list(self.matrix.shape),
+            "questions": self.questions,
+            "answers": self.answers,
+            "normalized": [normalize(question) for question in self.questions],
+            "vocabulary": vocabulary,
+        }).encode()
+        # unique to the thread, as several may rebuild the same index at once
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as file:
+                file.write(MAGIC)
+                file.write(struct.pack("<Q", len(header)))
+                file.write(header)
+                for array in (self.idf, self.matrix):
+                    file.write(b"\0" * (-file.tell() % ALIGNMENT))
+                    file.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save
+
+        The IDF vector and the matrix are memory-mapped rather than read, so
+        loading is quick and processes loading the same file share one copy
+        of it in the page cache.
+        """
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a compiled FAQ index")
+            (length,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(length))
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(f"{path} was compiled by an incompatible version")
+        rows, columns = header["shape"]
+        offset = _aligned(len(MAGIC) + 8 + length)
+        index = cls.__new__(cls)
+        index.questions = header["questions"]
+        index.answers = header["answers"]
+        index.ngram_range = tuple(header["ngram_range"])
+        index.vocabulary = {gram: column for column, gram in enumerate(header["vocabulary"])}
+        index.source_digest = header["source_digest"]
+        index.idf = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=(columns,))
+        offset = _aligned(offset + columns * 4)
+        index.matrix = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=(rows, columns))
+        return index
+
+
+def _aligned(offset):
+    return offset + (-offset % ALIGNMENT)
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file's contents"""
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def read_knowledge_base(path):
+    """Read a knowledge base file, a JSON list of {"question", "answer"} objects"""
+    with open(path, encoding="utf-8") as file:
+        return [(entry["question"], entry["answer"]) for entry in json.load(file)]
+
+
+def compile_knowledge_base(source, path):
+    """Build the index for a knowledge base file and save it
+
+    Returns:
+        The index
+    """
+    index = FaqIndex.from_pairs(read_knowledge_base(source))
+    index.save(path, source_digest=file_digest(source))
+    return index
+
+
+def load_knowledge_base(source, path=None):
+    """Load the index for a knowledge base file, compiling it if needed
+
+    The compiled index at `path` is used as long as it was built from the
+    current contents of `source`; otherwise it is rebuilt and saved again.
+
+    Args:
+        source: The knowledge base JSON file
+        path: Where the compiled index is kept, or None to always build in memory
+
+    Returns:
+        The FaqIndex
+    """
+    if path is None:
+        return FaqIndex.from_pairs(read_knowledge_base(source))
+    try:
+        index = FaqIndex.load(path)
+        if index.source_digest == file_digest(source):
+            return index
+    except (OSError, ValueError):
+        pass
+    return compile_knowledge_base(source, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a knowledge base file into an FAQ index")
+    parser.add_argument("source", help="JSON list of {\"question\", \"answer\"} objects")
+    parser.add_argument("output", help="where to write the compiled index")
+    args = parser.parse_args()
+    index = compile_knowledge_base(args.source, args.output)
+    print(f"Compiled {len(index)} questions with {len(index.vocabulary)} n-grams into {args.output}")
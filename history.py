@@ -0,0 +1,142 @@
+import json
+import time
+from collections import deque
+from itertools import islice
+
+
+class Turn:
+    """One question and its answer
+
+    Unpacks like the (question, answer) tuples the history used to hold.
+    """
+
+    __slots__ = ("question", "answer", "created")
+
+    def __init__(self, question, answer, created=None):
+        self.question = question
+        self.answer = answer
+        self.created = time.time() if created is None else created
+
+    def __iter__(self):
+        yield self.question
+        yield self.answer
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return f"Turn({self.question!r}, {self.answer!r})"
+
+    def to_dict(self):
+        return {"question": self.question, "answer": self.answer, "created": self.created}
+
+
+class History:
+    """Conversation history holding only the most recent turns in memory
+
+    The turns live in a ring buffer of `capacity` entries. When it is full,
+    the oldest turn makes room for the new one and, if a log file is given,
+    is appended to it as a line of JSON so nothing is lost.
+
+    Appending and indexing work like the plain list the history used to be,
+    and slicing the tail, as in history[-10:], only touches the turns that
+    are returned.
+
+    With a session store, the history starts from the latest turns stored
+    for its session and every new turn is added to the store too, so the
+    conversation can be picked up again after a restart.
+    """
+
+    def __init__(self, capacity=100, log_path=None, summary=None, store=None, session_id=None):
+        """
+        Args:
+            capacity: The most turns to keep in memory
+            log_path: Optional file to append evicted turns to
+            summary: Optional RollingSummary to fold evicted turns into
+            store: Optional SessionStore to load the turns from and save them to
+            session_id: The session to use in the store
+        """
+        self.capacity = capacity
+        self.log_path = log_path
+        self.summary = summary
+        self.store = store
+        self.session_id = session_id
+        self._turns = deque(maxlen=capacity)
+        self._log = None
+        if store is not None:
+            self._turns.extend(store.last(session_id, capacity))
+        # how many turns have ever been added
+        self.total = len(self._turns)
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __reversed__(self):
+        return reversed(self._turns)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            # fast path for the tail, the only slice the prompt builder takes
+            if start is not None and start < 0 and stop is None and step is None:
+                return self.last(-start)
+            return list(self._turns)[index]
+        return self._turns[index]
+
+    def append(self, pair):
+        """Add a turn, evicting the oldest one if the history is full
+
+        Args:
+            pair: A (question, answer) tuple or a Turn
+        """
+        turn = pair if isinstance(pair, Turn) else Turn(*pair)
+        if len(self._turns) == self.capacity:
+            self._evict(self._turns[0])
+        self._turns.append(turn)
+        self.total += 1
+        if self.store is not None:
+            self.store.append(self.session_id, turn)
+
+    def extend(self, pairs):
+        for pair in pairs:
+            self.append(pair)
+
+    def last(self, n):
+        """Return the latest n turns, oldest first"""
+        turns = list(islice(reversed(self._turns), n))
+        turns.reverse()
+        return turns
+
+    def snapshot(self):
+        """Return a copy of the turns in memory as (question, answer) tuples"""
+        return [tuple(turn) for turn in self._turns]
+
+    def summary_message(self):
+        """Return the summary of the evicted turns, or None if there is none"""
+        if self.summary is None:
+            return None
+        return self.summary.message()
+
+    def _evict(self, turn):
+        if self.summary is not None:
+            self.summary.add(turn)
+        if self.log_path is None:
+            return
+        if self._log is None:
+            self._log = open(self.log_path, "a", encoding="utf-8")
+        self._log.write(json.dumps(turn.to_dict()) + "\n")
+        self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import string
+import threading
+import zipfile
+
+import numpy as np
+
+from faq_index import file_digest, read_knowledge_base
+from text import NGRAM_RANGE, char_ngrams, normalize
+
+# the label of questions that don't belong to any intent
+OTHER = "other"
+# the placeholders answer templates can use, and how to find their values in a question
+SLOT_PATTERNS = {
+    "order_number": re.compile(r"(?<![\w-])#?([A-Za-z]{0,3}\d{5,})\b"),
+}
+FORMAT_VERSION = 1
+
+
+def read_intents(path):
+    """Read an intents file
+
+    The file is a JSON object mapping each intent to its "answers", a list
+    of templates, and "examples", questions that belong to it. An intent
+    named OTHER has only "examples": questions that look like one of the
+    intents but aren't, such as "Where is my refund?" next to "Where is
+    my order?", which teach the router where the intents end.
+    """
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def extract_slots(question):
+    """Find the values a question gives for the template placeholders"""
+    slots = {}
+    for name, pattern in SLOT_PATTERNS.items():
+        match = pattern.search(question)
+        if match:
+            slots[name] = match.group(1)
+    return slots
+
+
+def fill_template(templates, slots):
+    """Return the first template whose placeholders can all be filled, or None"""
+    for template in templates:
+        fields = {field for _, field, _, _ in string.Formatter().parse(template) if field}
+        if fields <= slots.keys():
+            return template.format(**slots)
+    return None
+
+
+class IntentRouter:
+    """Linear intent classifier over the character n-grams of a question
+
+    A softmax regression over the same TF-IDF features as the FAQ index.
+    Questions it is confident about get a templated answer; everything else,
+    including questions classified as OTHER, is left for the model.
+    """
+
+    def __init__(self, intents, templates, vocabulary, idf, weights, bias, ngram_range=NGRAM_RANGE):
+        """
+        Args:
+            intents: The labels, in the order of the rows of weights
+            templates: Dict from each intent to its answer templates
+            vocabulary: Dict from each n-gram to its feature column
+            idf: The inverse document frequency of each feature
+            weights: A matrix of one row of feature weights per intent
+            bias: The bias of each intent
+            ngram_range: The smallest and largest character n-gram size
+        """
+        self.intents = list(intents)
+        self.templates = templates
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.ngram_range = ngram_range
+        self.source_digest = None
+
+    @classmethod
+    def train(cls, examples, templates, ngram_range=NGRAM_RANGE, epochs=500, learning_rate=5.0, l2=1e-4):
+        """Fit the classifier by full batch gradient descent
+
+        Classes are weighted by how rare they are, so a large OTHER class
+        doesn't drown out the intents.
+
+        Args:
+            examples: (question, intent) pairs; the intent may be OTHER
+            templates: Dict from each intent to its answer templates
+            epochs: How many gradient steps to take
+            learning_rate: The size of each step
+            l2: How strongly large weights are penalized
+
+        Returns:
+            The trained IntentRouter
+        """
+        intents = sorted({intent for _, intent in examples})
+        grams = [char_ngrams(normalize(question), ngram_range) for question, _ in examples]
+        vocabulary = {}
+        for doc in grams:
+            for gram in doc:
+                vocabulary.setdefault(gram, len(vocabulary))
+        features = np.zeros((len(grams), len(vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(grams):
+            for gram in doc:
+                features[row, vocabulary[gram]] += 1
+        # smoothed inverse document frequency, as in the FAQ index
+        df = np.count_nonzero(features, axis=0)
+        idf = (np.log((1 + len(grams)) / (1 + df)) + 1).astype(np.float32)
+        features = _normalize_rows(features * idf)
+
+        labels = np.array([intents.index(intent) for _, intent in examples])
+        class_counts = np.bincount(labels, minlength=len(intents))
+        sample_weights = (len(labels) / (len(intents) * class_counts[labels]))[:, None]
+        sample_weights /= sample_weights.sum()
+        weights = np.zeros((len(intents), len(vocabulary)), dtype=np.float32)
+        bias = np.zeros(len(intents), dtype=np.float32)
+        for _ in range(epochs):
+            gradient = _softmax(features @ weights.T + bias)
+            gradient[np.arange(len(labels)), labels] -= 1
+            gradient *= sample_weights
+            weights -= learning_rate * (gradient.T @ features + l2 * weights)
+            bias -= learning_rate * gradient.sum(axis=0)
+        return cls(intents, templates, vocabulary, idf, weights, bias, ngram_range)
+
+    def vectorize(self, text):
+        """Turn text into a unit TF-IDF vector; unseen n-grams are ignored"""
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for gram in char_ngrams(normalize(text), self.ngram_range):
+            column = self.vocabulary.get(gram)
+            if column is not None:
+                vector[column] += 1
+        return _normalize_rows(vector * self.idf)
+
+    def classify(self, question):
+        """Return the most likely intent of a question and its probability"""
+        probabilities = _softmax(self.weights @ self.vectorize(question) + self.bias)
+        best = int(np.argmax(probabilities))
+        return self.intents[best], float(probabilities[best])
+
+    def route(self, question, threshold):
+        """Answer a question from a template if its intent is clear
+
+        Args:
+            question: The customer's question
+            threshold: The minimum probability of the intent
+
+        Returns:
+            A tuple of the intent and the templated answer; the answer is
+            None if the question should go to the model
+        """
+        intent, probability = self.classify(question)
+        if intent == OTHER or probability < threshold:
+            return intent, None
+        return intent, fill_template(self.templates.get(intent, ()), extract_slots(question))
+
+    def save(self, path, source_digest=None):
+        """Write the trained router to a NumPy .npz file
+
+        Like FaqIndex.save, the file is written next to `path` and renamed
+        over it, so a process starting up meanwhile never reads half of it.
+        """
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "source_digest": source_digest,
+            "ngram_range": list(self.ngram_range),
+            "intents": self.intents,
+            "templates": self.templates,
+            "vocabulary": sorted(self.vocabulary, key=self.vocabulary.get),
+        })
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # a file object, so numpy doesn't add .npz to the name
+            with open(temporary, "wb") as file:
+                np.savez(file, header=np.array(header), idf=self.idf, weights=self.weights, bias=self.bias)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Load a router written by save"""
+        with np.load(path) as data:
+            header = json.loads(str(data["header"]))
+            if header["version"] != FORMAT_VERSION:
+                raise ValueError(f"{path} was compiled by an incompatible version")
+            router = cls(
+                header["intents"],
+                header["templates"],
+                {gram: column for column, gram in enumerate(header["vocabulary"])},
+                data["idf"],
+                data["weights"],
+                data["bias"],
+                tuple(header["ngram_range"]),
+            )
+        router.source_digest = header["source_digest"]
+        return router
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def training_examples(knowledge_base, intents):
+    """Label the questions to train on
+
+    The examples of each intent are labelled with it, and every FAQ question
+    that isn't one of them is labelled OTHER, like the intents file's own
+    OTHER examples.
+
+    Args:
+        knowledge_base: The FAQ (question, answer) pairs
+        intents: The intents, as read by read_intents
+
+    Returns:
+        A list of (question, intent) pairs
+    """
+    examples = [
+        (question, intent) for intent, spec in intents.items() for question in spec["examples"]
+    ]
+    labelled = {normalize(question) for question, _ in examples}
+    examples.extend(
+        (question, OTHER) for question, _ in knowledge_base if normalize(question) not in labelled
+    )
+    return examples
+
+
+def read_held_out(path):
+    """Read a file of questions the router isn't trained on
+
+    The file is a JSON list of {"question", "intent"} objects; the intent
+    is OTHER for questions that should go to the model.
+
+    Returns:
+        A list of (question, intent) pairs
+    """
+    with open(path, encoding="utf-8") as file:
+        return [(record["question"], record["intent"]) for record in json.load(file)]
+
+
+def calibrate_threshold(router, held_out):
+    """Find the lowest threshold at which no held-out question gets a wrong template
+
+    A question gets a wrong template when the router is sure of an intent
+    it doesn't have, so the threshold is set just above the most confident
+    such mistake. Questions classified as OTHER only cost a model call.
+
+    Args:
+        router: The trained IntentRouter
+        held_out: (question, intent) pairs, as read by read_held_out
+
+    Returns:
+        A tuple of the threshold and the share of the held-out questions
+        with an intent that get their template at it
+    """
+    results = [(router.classify(question), intent) for question, intent in held_out]
+    mistakes = [probability for (predicted, probability), intent in results if predicted not in (OTHER, intent)]
+    # rounded up to the next hundredth, so the worst mistake falls below it
+    threshold = math.floor(max(mistakes) * 100 + 1) / 100 if mistakes else 0.0
+    with_intent = [(predicted, probability, intent) for (predicted, probability), intent in results if intent != OTHER]
+    answered = sum(predicted == intent and probability >= threshold for predicted, probability, intent in with_intent)
+    return threshold, answered / len(with_intent) if with_intent else 0.0
+
+
+def sources_digest(knowledge_base_path, intents_path):
+    """Return one digest for the two files a router is trained from"""
+    return hashlib.sha256(
+        (file_digest(knowledge_base_path) + file_digest(intents_path)).encode()
+    ).hexdigest()
+
+
+def train_router(knowledge_base_path, intents_path):
+    """Train a router on the FAQ and the intents file"""
+    intents = read_intents(intents_path)
+    return IntentRouter.train(
+        training_examples(read_knowledge_base(knowledge_base_path), intents),
+        {intent: spec["answers"] for intent, spec in intents.items() if intent != OTHER},
+    )
+
+
+def compile_router(knowledge_base_path, intents_path, path):
+    """Train a router on the FAQ and the intents file and save it
+
+    Returns:
+        The router
+    """
+    router = train_router(knowledge_base_path, intents_path)
+    router.save(path, source_digest=sources_digest(knowledge_base_path, intents_path))
+    return router
+
+
+def load_router(knowledge_base_path, intents_path, path=None):
+    """Load the router for the FAQ and intents files, training it if needed
+
+    The saved router at `path` is used as long as it was trained on the
+    current contents of both files; otherwise it is trained and saved again.
+
+    Args:
+        knowledge_base_path: The knowledge base JSON file
+        intents_path: The intents JSON file
+        path: Where the trained router is kept, or None to always train in memory
+
+    Returns:
+        The IntentRouter
+    """
+    if path is None:
+        return train_router(knowledge_base_path, intents_path)
+    try:
+        router = IntentRouter.load(path)
+        if router.source_digest == sources_digest(knowledge_base_path, intents_path):
+            return router
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # a missing, damaged or outdated file is trained again
+        pass
+    return compile_router(knowledge_base_path, intents_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the intent router on a knowledge base and an intents file")
+    parser.add_argument("knowledge_base", help="JSON list of {\"question\", \"answer\"} objects")
+    parser.add_argument("intents", help="JSON object of intents with their answers and examples")
+    parser.add_argument("output", help="where to write the trained router")
+    parser.add_argument("--held-out", help="JSON list of {\"question\", \"intent\"} objects to calibrate the threshold on")
+    args = parser.parse_args()
+    router = compile_router(args.knowledge_base, args.intents, args.output)
+    print(f"Trained {len(router.intents)} intents on {len(router.vocabulary)} n-grams into {args.output}")
+    if args.held_out:
+        threshold, coverage = calibrate_threshold(router, read_held_out(args.held_out))
+        print(f"A threshold of {threshold:.2f} gives no wrong templates and answers {coverage:.0%} of the held-out intent questions")
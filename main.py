@@ -1,58 +1,712 @@
+import atexit
+import json
 import os
-import openai
+import time
+from concurrent.futures import Future
 from dotenv import load_dotenv
 from colorama import Fore, Back, Style
 
+from cascade import Cascade, CascadeRun
+from history import History
+from metrics import TOKEN_BUCKETS, Registry
+from backends import create_backend
+from openai_client import APIError, RateLimitError, RetryableAPIError
+from moderation import Prescreen, moderation_cache, moderation_errors
+from parallel import moderate_while_responding, moderate_while_streaming
+from profiles import ProfileRegistry
+from prompt import build_messages, count_tokens, select_context
+from response_cache import ResponseCache, SqliteResponseCache, cache_key
+from scheduler import CircuitOpenError, Scheduler
+from semantic_cache import SemanticCache
+from singleflight import FlightTimeout, SingleFlight
+from session_store import SqliteSessionStore
+from summary import SUMMARY_INSTRUCTIONS, RollingSummary, format_turns
+from transcripts import TranscriptSink, transcript_turn
+
 # load values from the .env file if it exists
 load_dotenv()
 
-# configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# where completions and moderation results come from: "openai" for the
+# OpenAI API, "http" for an OpenAI-compatible server at LLM_API_BASE, such as
+# a self-hosted model, or "stub" for made-up answers without the network.
+# Moderation can use a different backend, as self-hosted servers often
+# don't moderate
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+MODERATION_BACKEND = os.getenv("MODERATION_BACKEND", LLM_BACKEND)
+# the URL of the "http" backend, and the key it is sent as a bearer token, if
+# the server wants one; the "openai" backend reads the SDK's settings instead
+LLM_API_BASE = os.getenv("LLM_API_BASE")
+LLM_API_KEY = os.getenv("LLM_API_KEY")
+# how many connections an "http" backend keeps open, shared by all threads
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "10"))
+
+
+def configured_backend(name):
+    """Create a backend by name with the settings above"""
+    if name == "http":
+        return create_backend(name, api_base=LLM_API_BASE, api_key=LLM_API_KEY, pool_size=LLM_POOL_SIZE)
+    return create_backend(name)
+
+
+# the openai SDK is only imported when the first call is made, so commands
+# that never reach the API start quickly
+backend = configured_backend(LLM_BACKEND)
+moderation_backend = backend
+if MODERATION_BACKEND != LLM_BACKEND:
+    moderation_backend = configured_backend(MODERATION_BACKEND)
 
 INSTRUCTIONS = """<<PUT THE PROMPT HERE>>"""
 
+MODEL = "gpt-3.5-turbo"
 TEMPERATURE = 0.5
 MAX_TOKENS = 500
 FREQUENCY_PENALTY = 0
 PRESENCE_PENALTY = 0.6
+# the models tried for each question, cheapest first. By default there is
+# one tier, answering with the parameters above. Set MODEL_TIERS to a JSON
+# list, such as [{"model": "gpt-3.5-turbo"}, {"model": "gpt-4"}], to turn
+# on the cascade: each tier overrides the parameters above, and an answer
+# that is a refusal or cut short by max_tokens is asked again of the next tier
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS") or "null") or [{}]
+# with more than one tier, set to a score such as 0.3 to start questions that
+# match the knowledge base worse than it at the second tier
+MIN_RETRIEVAL_SCORE = float(os.getenv("MIN_RETRIEVAL_SCORE")) if os.getenv("MIN_RETRIEVAL_SCORE") else None
+
+cascade = Cascade(MODEL_TIERS, min_retrieval_score=MIN_RETRIEVAL_SCORE)
+
 # limits how many questions we include in the prompt
 MAX_CONTEXT_QUESTIONS = 10
+# how many turns of the chat we keep in memory
+HISTORY_SIZE = MAX_CONTEXT_QUESTIONS
+# set to a file name to keep the turns that no longer fit in memory
+HISTORY_LOG_PATH = os.getenv("HISTORY_LOG_PATH")
+# set to a database file to keep conversations across restarts; every
+# process opening the same file sees the same sessions
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH")
+# the session the chat continues when a session store is set
+SESSION_ID = os.getenv("SESSION_ID", "default")
+
+session_store = None
+if SESSION_STORE_PATH:
+    session_store = SqliteSessionStore(SESSION_STORE_PATH)
+    # write the turns still queued when the chat ends
+    atexit.register(session_store.close)
+# set to a file name, such as transcripts.jsonl.gz, to keep a transcript of
+# every turn for analytics and replay; turns are written in the background
+# and the file is rotated once it grows large
+TRANSCRIPT_PATH = os.getenv("TRANSCRIPT_PATH")
+
+transcripts = None
+if TRANSCRIPT_PATH:
+    transcripts = TranscriptSink(TRANSCRIPT_PATH)
+    atexit.register(transcripts.close)
+# how many tokens of turns that fell out of the history we collect before
+# folding them into the running summary, and how long the summary may get
+SUMMARY_THRESHOLD = 400
+SUMMARY_MAX_TOKENS = 300
+# set to a JSON file of prompt profiles to serve several brands from one
+# process; each profile has its own instructions, model parameters and
+# knowledge base, and the file is reloaded when it changes
+PROFILES_PATH = os.getenv("PROFILES_PATH")
+# the profile the interactive chat uses, by default the file's default one
+PROFILE = os.getenv("PROFILE")
+# how many of the most relevant knowledge base entries we include in the prompt
+CONTEXT_TOP_K = 5
+# the number of tokens the model can handle, prompt and reply together
+CONTEXT_WINDOW = 4096
+# limits how many tokens we send, leaving room for MAX_TOKENS of reply
+PROMPT_TOKEN_BUDGET = CONTEXT_WINDOW - MAX_TOKENS
+# print responses as they are generated rather than all at once
+STREAM_RESPONSES = True
+# start the completion while the moderation check is still running
+CONCURRENT_MODERATION = True
+# how many responses we cache, and for how many seconds
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+# set to a file name to keep cached responses across restarts
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH")
+
+if RESPONSE_CACHE_PATH:
+    response_cache = SqliteResponseCache(
+        RESPONSE_CACHE_PATH, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL
+    )
+else:
+    response_cache = ResponseCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+# also answer questions that are worded differently from a cached one, if
+# they are at least this similar; set to None to turn this off
+SEMANTIC_CACHE_THRESHOLD = 0.85
+SEMANTIC_CACHE_SIZE = 1024
+
+semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD, maxsize=SEMANTIC_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL
+)
+
+# the account's rate limits, shared by completion and moderation calls
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 90000
+# how often a call is retried after a rate limit, timeout or server error
+MAX_RETRIES = 5
+# seconds before a single call to the API is given up on
+REQUEST_TIMEOUT = 30
+# concurrent requests for the same moderation or completion share one API
+# call; the requests that wait for another's call give up after this many seconds
+COALESCE_TIMEOUT = 2 * REQUEST_TIMEOUT
+# errors worth retrying; anything else is a problem with the request
+RETRYABLE_ERRORS = (RetryableAPIError,)
+# retryable errors that mean the API is busy rather than down, so they don't trip the circuit breaker
+RATE_LIMIT_ERRORS = (RateLimitError,)
+# errors that fail a turn without ending the chat
+API_ERRORS = (APIError, CircuitOpenError, FlightTimeout)
+
+scheduler = Scheduler(
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+    retryable=RETRYABLE_ERRORS,
+    rate_limited=RATE_LIMIT_ERRORS,
+    max_retries=MAX_RETRIES,
+    timeout=REQUEST_TIMEOUT,
+)
+moderation_flight = SingleFlight(COALESCE_TIMEOUT)
+completion_flight = SingleFlight(COALESCE_TIMEOUT)
+
+# set to a file name to also append every measurement to it as a line of JSON
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH")
+
+registry = Registry(METRICS_TRACE_PATH)
+moderation_seconds = registry.histogram(
+    "chatbot_moderation_seconds", "Time taken by moderation API calls"
+)
+completion_seconds = registry.histogram(
+    "chatbot_completion_seconds", "Time taken by chat completion API calls, up to the last token"
+)
+first_token_seconds = registry.histogram(
+    "chatbot_first_token_seconds", "Time until the first token of streamed chat completions"
+)
+prompt_tokens = registry.histogram(
+    "chatbot_prompt_tokens", "Prompt tokens per chat completion", TOKEN_BUCKETS
+)
+completion_tokens = registry.histogram(
+    "chatbot_completion_tokens", "Completion tokens per chat completion", TOKEN_BUCKETS
+)
+cached_answers = registry.counter(
+    "chatbot_cached_answers_total", "Questions answered from a response cache"
+)
+intent_answers = registry.counter(
+    "chatbot_intent_answers_total", "Questions answered from an intent template"
+)
+escalations = registry.counter(
+    "chatbot_escalations_total", "Questions passed on to a larger model tier, by reason"
+)
+tier_answers = registry.counter(
+    "chatbot_tier_answers_total", "Questions answered by each model tier"
+)
+flagged_questions = registry.counter(
+    "chatbot_flagged_questions_total", "Questions that didn't pass the moderation check"
+)
+
+# profiles only set what differs from the configuration above
+PROFILE_DEFAULTS = {
+    "instructions": INSTRUCTIONS,
+    "model": MODEL,
+    "temperature": TEMPERATURE,
+    "max_tokens": MAX_TOKENS,
+    "top_p": 1,
+    "frequency_penalty": FREQUENCY_PENALTY,
+    "presence_penalty": PRESENCE_PENALTY,
+    "max_context_questions": MAX_CONTEXT_QUESTIONS,
+    "tiers": MODEL_TIERS,
+    "min_retrieval_score": MIN_RETRIEVAL_SCORE,
+}
+
+profiles = ProfileRegistry(PROFILES_PATH, PROFILE_DEFAULTS) if PROFILES_PATH else None
+if transcripts is not None:
+    registry.collector(transcripts.collect_metrics)
+
+# how many moderation results we cache, and for how many seconds
+MODERATION_CACHE_SIZE = 4096
+MODERATION_CACHE_TTL = 24 * 60 * 60
+# settle obviously safe or unsafe questions locally before calling the API
+MODERATION_PRESCREEN = Prescreen()
+
+
+def get_profile(name=None):
+    """Return a profile from PROFILES_PATH
+
+    Args:
+        name: The profile's name, or None for the default profile
+
+    Returns:
+        The Profile, or None if there is no profiles file, in which case
+        the configuration above is used
+
+    Raises:
+        KeyError: If there is no profile with the name
+    """
+    if profiles is None:
+        return None
+    return profiles.get(name)
+
+
+def get_messages(instructions, previous_questions_and_answers, new_question, knowledge_base=None, profile=None):
+    """Build the messages to send to ChatCompletion
+
+    Args:
+        instructions: The instructions for the chat bot - this determines how it will behave
+        previous_questions_and_answers: Chat history
+        new_question: The new question to ask the bot
+        knowledge_base: Optional FaqIndex to pick relevant questions and answers from
+        profile: Optional Profile to use instead of the configuration above; the
+            instructions and knowledge base should be the profile's
+
+    Returns:
+        The list of messages
+    """
+    # pick the most relevant knowledge base entries and the latest turns
+    context, history = select_context(
+        previous_questions_and_answers,
+        new_question,
+        knowledge_base,
+        top_k=CONTEXT_TOP_K,
+        recent=profile.max_context_questions if profile is not None else MAX_CONTEXT_QUESTIONS,
+    )
+    # turns older than the history are only sent as a summary
+    summary = None
+    if isinstance(previous_questions_and_answers, History):
+        summary = previous_questions_and_answers.summary_message()
+    # build the messages, keeping the prompt within the token budget
+    instruction_tokens = None
+    if profile is not None and instructions == profile.instructions:
+        # counted once when the profile was loaded
+        instruction_tokens = profile.instruction_tokens
+    return build_messages(
+        instructions,
+        new_question,
+        context,
+        history,
+        max_tokens=PROMPT_TOKEN_BUDGET,
+        summary=summary,
+        instruction_tokens=instruction_tokens,
+    )
+
+
+def completion_params(profile=None):
+    """Return the model parameters we send with every completion, or a profile's"""
+    if profile is not None:
+        return dict(profile.params)
+    return {
+        "model": MODEL,
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+        "top_p": 1,
+        "frequency_penalty": FREQUENCY_PENALTY,
+        "presence_penalty": PRESENCE_PENALTY,
+    }
+
+
+def create_completion(messages, stream=False, profile=None, **overrides):
+    """Call ChatCompletion with the configured model parameters
+
+    Args:
+        messages: The messages to send
+        stream: Whether to stream the response
+        profile: Optional Profile whose model parameters to use
+        **overrides: Parameters to use instead of the configured ones, such as a model tier's
+
+    Returns:
+        The backends.Completion, or with stream an iterator of (content, finish_reason)
+    """
+    params = {**completion_params(profile), **overrides}
+    # the prompt and the longest possible reply count towards the token limit
+    tokens = sum(count_tokens(message["content"]) for message in messages) + params["max_tokens"]
+    return scheduler.call(backend.stream if stream else backend.complete, messages, tokens=tokens, **params)
+
+
+def cascade_for(profile=None):
+    """Return the model cascade of a profile, or the configured one"""
+    return profile.cascade if profile is not None else cascade
+
+
+def tier_model(tier, profile=None):
+    """Return the model a cascade tier uses"""
+    return cascade_for(profile).tiers[tier].get("model", completion_params(profile)["model"])
+
+
+def first_tier(new_question, knowledge_base=None, profile=None):
+    """Pick the cascade tier to start a question at
+
+    Questions that match the knowledge base poorly skip the cheapest tier.
+    """
+    score = None
+    if knowledge_base is not None:
+        results = knowledge_base.search(new_question, k=1)
+        score = results[0][1] if results else 0.0
+    tier, reason = cascade_for(profile).first_tier(score)
+    if reason is not None:
+        escalations.inc(reason=reason, model=tier_model(tier, profile))
+    return tier
+
+
+class MeteredRun(CascadeRun):
+    """A CascadeRun of a chat answer that records the chat metrics
+
+    Used by main.py and server.py alike, so the cascade behaves and is
+    measured the same way in both.
+    """
+
+    def __init__(self, messages, tier, profile=None, usage=None):
+        """
+        Args:
+            messages: The messages of the request
+            tier: The tier to start at, as first_tier picks
+            profile: Optional Profile the messages were built with
+            usage: Optional dict the tokens spent are added to
+        """
+        super().__init__(cascade_for(profile), messages, tier)
+        self.profile = profile
+        self.usage = usage
+        self.start = time.perf_counter()
+
+    def on_first_piece(self):
+        first_token_seconds.observe(time.perf_counter() - self.start)
+
+    def on_attempt(self, request, text, usage=None):
+        if usage is None:
+            # streamed completions come without usage, so count the tokens ourselves
+            usage = {
+                "prompt_tokens": sum(count_tokens(message["content"]) for message in request),
+                "completion_tokens": count_tokens(text),
+            }
+        record_usage(usage, total=self.usage)
+
+    def on_escalation(self, reason):
+        escalations.inc(reason=reason, model=tier_model(self.tier, self.profile))
+
+    def on_done(self):
+        tier_answers.inc(model=tier_model(self.tier, self.profile))
+
+
+def record_usage(usage, call="chat", total=None):
+    """Record the token counts of a completion
+
+    Args:
+        usage: The "usage" block of the completion response
+        call: What the completion was for, such as "chat" or "summary"
+        total: Optional dict to add the token counts to
+    """
+    prompt_tokens.observe(usage["prompt_tokens"], call=call)
+    completion_tokens.observe(usage["completion_tokens"], call=call)
+    if total is not None:
+        for name in ("prompt_tokens", "completion_tokens"):
+            total[name] = total.get(name, 0) + usage[name]
+
+
+def semantic_namespace(instructions, previous_questions_and_answers, profile=None):
+    """Return the conversation state semantic cache entries are kept under
+
+    The instructions, summary, recent history and model parameters: answers
+    never cross over from another conversation, whose turns may hold a
+    customer's details. The knowledge base entries retrieved for a question
+    are left out, as they are picked by the question itself and paraphrases
+    would otherwise never share an entry.
+
+    Args:
+        instructions: The instructions for the chat bot
+        previous_questions_and_answers: Chat history
+        profile: Optional Profile the messages are built with
+    """
+    recent = profile.max_context_questions if profile is not None else MAX_CONTEXT_QUESTIONS
+    summary = None
+    if isinstance(previous_questions_and_answers, History):
+        summary = previous_questions_and_answers.summary_message()
+    return json.dumps(
+        [
+            profile.name if profile is not None else None,
+            instructions,
+            summary,
+            [list(pair) for pair in previous_questions_and_answers[-recent:]] if recent else [],
+            completion_params(profile),
+        ],
+        sort_keys=True,
+    )
 
 
-def get_response(instructions, previous_questions_and_answers, new_question):
+def get_cached_response(messages, profile=None, namespace=None):
+    """Look a request up in the response caches
+
+    The exact cache is tried first. The semantic cache compares only the
+    question, within the conversation state of `namespace`.
+
+    Args:
+        messages: The messages that would be sent to ChatCompletion
+        profile: Optional Profile the messages were built with
+        namespace: The semantic_namespace of the request; without one the
+            semantic cache isn't used
+
+    Returns:
+        The cached response text, or None
+    """
+    params = completion_params(profile)
+    response = response_cache.get(cache_key(messages, **params))
+    if response is not None:
+        cached_answers.inc(cache="response")
+        return response
+    if SEMANTIC_CACHE_THRESHOLD is not None and namespace is not None:
+        response = semantic_cache.get(messages[-1]["content"], namespace)
+        if response is not None:
+            cached_answers.inc(cache="semantic")
+    return response
+
+
+def cache_response(messages, response, profile=None, namespace=None):
+    """Store a response in the response caches, taking `namespace` like get_cached_response"""
+    params = completion_params(profile)
+    response_cache.set(cache_key(messages, **params), response)
+    if SEMANTIC_CACHE_THRESHOLD is not None and namespace is not None:
+        semantic_cache.set(messages[-1]["content"], response, namespace)
+
+
+def get_response(
+    instructions, previous_questions_and_answers, new_question, knowledge_base=None, profile=None, usage=None, moderated=None
+):
     """Get a response from ChatCompletion
 
     Args:
         instructions: The instructions for the chat bot - this determines how it will behave
         previous_questions_and_answers: Chat history
         new_question: The new question to ask the bot
+        knowledge_base: Optional FaqIndex to pick relevant questions and answers from
+        profile: Optional Profile to use instead of the configuration above; the
+            instructions and knowledge base should be the profile's
+        usage: Optional dict the tokens spent on the answer are added to;
+            answers from a cache or another caller's call add nothing
+        moderated: Optional Future of whether the question passed the
+            moderation check, when it runs alongside; the answer is only
+            cached once it has, so a flagged question's answer is never served
 
     Returns:
         The response text
     """
-    # build the messages
-    messages = [
-        { "role": "system", "content": instructions },
-    ]
-    # add the previous questions and answers
-    for question, answer in previous_questions_and_answers[-MAX_CONTEXT_QUESTIONS:]:
-        messages.append({ "role": "user", "content": question })
-        messages.append({ "role": "assistant", "content": answer })
-    # add the new question
-    messages.append({ "role": "user", "content": new_question })
-
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
-        temperature=TEMPERATURE,
-        max_tokens=MAX_TOKENS,
-        top_p=1,
-        frequency_penalty=FREQUENCY_PENALTY,
-        presence_penalty=PRESENCE_PENALTY,
+    messages = get_messages(instructions, previous_questions_and_answers, new_question, knowledge_base, profile)
+    namespace = semantic_namespace(instructions, previous_questions_and_answers, profile)
+    # answer repeated questions from the cache
+    response = get_cached_response(messages, profile, namespace)
+    if response is not None:
+        return response
+    # customers asking the same thing at the same time share one answer
+    key = cache_key(messages, **completion_params(profile))
+    return completion_flight.do(
+        key, _complete, messages, new_question, knowledge_base, profile, usage, moderated, namespace
+    )
+
+
+def _complete(messages, new_question, knowledge_base, profile, usage, moderated, namespace):
+    # start at the cheapest suitable tier and escalate while the answer falls short
+    run = MeteredRun(messages, first_tier(new_question, knowledge_base, profile), profile, usage)
+    while not run.done:
+        with completion_seconds.time(call="chat"):
+            completion = create_completion(run.request, profile=profile, **run.params)
+        run.answered(completion.text, completion.finish_reason, completion.usage)
+    response = run.answer
+    if moderated is None or moderated.result():
+        cache_response(messages, response, profile, namespace)
+    return response
+
+
+def get_response_stream(
+    instructions, previous_questions_and_answers, new_question, knowledge_base=None, profile=None, usage=None, moderated=None
+):
+    """Stream a response from ChatCompletion
+
+    Takes the same arguments as get_response. Goes through the model
+    cascade like get_response; the start of an answer that could still be
+    escalated is held back until it is clearly not a refusal, and an answer
+    cut short by max_tokens is finished by the next tier.
+
+    Yields:
+        Pieces of the response text as they are generated
+    """
+    messages = get_messages(instructions, previous_questions_and_answers, new_question, knowledge_base, profile)
+    namespace = semantic_namespace(instructions, previous_questions_and_answers, profile)
+    response = get_cached_response(messages, profile, namespace)
+    if response is not None:
+        yield response
+        return
+    # customers asking the same thing at the same time share one answer; only
+    # the first sees it streamed, the others get it once it is complete
+    key = cache_key(messages, **completion_params(profile))
+    yield from completion_flight.stream(
+        key, _stream, messages, new_question, knowledge_base, profile, usage, moderated, namespace
     )
-    return completion.choices[0].message.content
 
 
+def _stream(messages, new_question, knowledge_base, profile, usage, moderated, namespace):
+    run = MeteredRun(messages, first_tier(new_question, knowledge_base, profile), profile, usage)
+    while not run.done:
+        for content, finish in create_completion(run.request, stream=True, profile=profile, **run.params):
+            piece = run.feed(content, finish)
+            if piece:
+                yield piece
+            if run.stopped:
+                break
+        piece = run.end_attempt()
+        if piece:
+            yield piece
+    completion_seconds.observe(time.perf_counter() - run.start, call="chat")
+    response = run.answer
+    # only cache responses that were streamed to the end, to a question that passed
+    if moderated is None or moderated.result():
+        cache_response(messages, response, profile, namespace)
+
+
+def prefetch_response(messages, cancelled=None, profile=None):
+    """Answer a question ahead of time and cache the answer
+
+    Used to answer likely follow-up questions while the customer is typing.
+    The cheapest tier is used, and the answer is streamed so the call can be
+    dropped as soon as it is cancelled.
+
+    Args:
+        messages: The messages the real request for the question would send
+        cancelled: Optional threading.Event that is set when the work is no longer wanted
+        profile: Optional Profile the messages were built with
+
+    Returns:
+        The response text, or None if it was cancelled or would have been escalated
+    """
+    key = cache_key(messages, **completion_params(profile))
+    if key in response_cache:
+        return response_cache.get(key)
+    pieces = []
+    finish_reason = None
+    models = cascade_for(profile)
+    for content, finish in create_completion(messages, stream=True, profile=profile, **models.tiers[0]):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        finish_reason = finish or finish_reason
+        if content:
+            pieces.append(content)
+    response = "".join(pieces)
+    record_usage({
+        "prompt_tokens": sum(count_tokens(message["content"]) for message in messages),
+        "completion_tokens": count_tokens(response),
+    }, call="prefetch")
+    # an answer the cascade would escalate is left for the real request
+    if models.escalation_reason(0, response, finish_reason) is not None:
+        return None
+    cache_response(messages, response, profile)
+    return response
+
+
+def get_summary(summary, turns, summary_backend=None):
+    """Fold turns of the chat into a running summary
+
+    Args:
+        summary: The summary so far, or an empty string
+        turns: The (question, answer) pairs to add to it
+        summary_backend: The Backend to summarize with, by default the one answers come from
+
+    Returns:
+        The updated summary
+    """
+    with completion_seconds.time(call="summary"):
+        completion = scheduler.call(
+            (summary_backend or backend).complete,
+            [
+                { "role": "system", "content": SUMMARY_INSTRUCTIONS },
+                { "role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{format_turns(turns)}" },
+            ],
+            tokens=SUMMARY_MAX_TOKENS + sum(count_tokens(q) + count_tokens(a) for q, a in turns),
+            model=MODEL,
+            temperature=0,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+    record_usage(completion.usage, call="summary")
+    return completion.text
+
+
+def new_history(session_id=SESSION_ID):
+    """Create the history for a chat, summarizing the turns it evicts
+
+    With a session store the chat continues from the turns stored for the
+    session.
+    """
+    summary = RollingSummary(get_summary, threshold=SUMMARY_THRESHOLD, errors=API_ERRORS)
+    return History(
+        HISTORY_SIZE, HISTORY_LOG_PATH, summary=summary, store=session_store, session_id=session_id
+    )
+
+
+def get_moderated_response(
+    instructions, previous_questions_and_answers, new_question, knowledge_base=None, profile=None, usage=None
+):
+    """Check a question is safe and get the response to it
+
+    Depending on STREAM_RESPONSES the response is either the full text or an
+    iterator over pieces of it. With CONCURRENT_MODERATION the completion is
+    started alongside the moderation check, but it is still only returned
+    once the question has passed.
+
+    Takes the same arguments as get_response.
+
+    Returns:
+        A tuple of the moderation errors and the response; the response is
+        None if the question didn't pass the moderation check
+    """
+    if not CONCURRENT_MODERATION:
+        args = (instructions, previous_questions_and_answers, new_question, knowledge_base, profile, usage)
+        errors = get_moderation(new_question)
+        if errors:
+            return errors, None
+        if STREAM_RESPONSES:
+            return None, get_response_stream(*args)
+        return None, get_response(*args)
+    # the completion can finish before the check, but its answer waits for it to be cached
+    moderated = Future()
+    args = (instructions, previous_questions_and_answers, new_question, knowledge_base, profile, usage, moderated)
+
+    def moderate():
+        passed = False
+        try:
+            errors = get_moderation(new_question)
+            passed = not errors
+            return errors
+        finally:
+            moderated.set_result(passed)
+
+    if STREAM_RESPONSES:
+        return moderate_while_streaming(moderate, lambda: get_response_stream(*args))
+    return moderate_while_responding(moderate, lambda: get_response(*args))
+
+
+def print_response(label, response):
+    """Print a response, writing it out piece by piece if it is streamed
+
+    Args:
+        label: The text to print before the response
+        response: The response text, or an iterable of pieces of it
+
+    Returns:
+        The full response text
+    """
+    print(Fore.CYAN + Style.BRIGHT + label + Style.NORMAL, end="", flush=True)
+    if isinstance(response, str):
+        print(response)
+        return response
+    pieces = []
+    for piece in response:
+        print(piece, end="", flush=True)
+        pieces.append(piece)
+    print()
+    return "".join(pieces)
+
+
+@moderation_cache(
+    maxsize=MODERATION_CACHE_SIZE,
+    ttl=MODERATION_CACHE_TTL,
+    prescreen=MODERATION_PRESCREEN,
+    flight=moderation_flight,
+)
 def get_moderation(question):
     """
     Check the question is safe to ask the model
@@ -62,39 +716,96 @@ def get_moderation(question):
 
     Returns a list of errors if the question is not safe, otherwise returns None
     """
+    # the moderation calls don't take a request timeout
+    with moderation_seconds.time():
+        result = scheduler.call(moderation_backend.moderate, question)
+    errors = moderation_errors(result)
+    if errors:
+        flagged_questions.inc()
+    return errors
 
-    errors = {
-        "hate": "Content that expresses, incites, or promotes hate based on race, gender, ethnicity, religion, nationality, sexual orientation, disability status, or caste.",
-        "hate/threatening": "Hateful content that also includes violence or serious harm towards the targeted group.",
-        "self-harm": "Content that promotes, encourages, or depicts acts of self-harm, such as suicide, cutting, and eating disorders.",
-        "sexual": "Content meant to arouse sexual excitement, such as the description of sexual activity, or that promotes sexual services (excluding sex education and wellness).",
-        "sexual/minors": "Sexual content that includes an individual who is under 18 years old.",
-        "violence": "Content that promotes or glorifies violence or celebrates the suffering or humiliation of others.",
-        "violence/graphic": "Violent content that depicts death, violence, or serious physical injury in extreme graphic detail.",
+
+@registry.collector
+def collect_metrics():
+    """Report the counters kept by the caches and the scheduler"""
+    caches = {
+        "response": response_cache,
+        "semantic": semantic_cache,
+        "moderation": get_moderation.cache,
     }
-    response = openai.Moderation.create(input=question)
-    if response.results[0].flagged:
-        # get the categories that are flagged and generate a message
-        result = [
-            error
-            for category, error in errors.items()
-            if response.results[0].categories[category]
-        ]
-        return result
-    return None
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield "chatbot_cache_hits_total", "counter", "Cache lookups that found an entry", {"cache": name}, stats["hits"]
+        yield "chatbot_cache_misses_total", "counter", "Cache lookups that found nothing", {"cache": name}, stats["misses"]
+        yield "chatbot_cache_entries", "gauge", "Entries in the cache", {"cache": name}, stats["size"]
+    yield "chatbot_api_retries_total", "counter", "API calls retried by the scheduler", {}, scheduler.retries
+    for name, flight in (("moderation", moderation_flight), ("completion", completion_flight)):
+        yield "chatbot_coalesced_requests_total", "counter", "Requests that shared another request's API call", {"call": name}, flight.shared
+
+
+def record_turn(question, profile, start, usage, answer=None, moderation=None, session_id=SESSION_ID, **fields):
+    """Add a turn of the chat to the transcripts, if they are kept
+
+    Args:
+        question: The question that was asked
+        profile: The Profile that answered it, or None
+        start: The time.perf_counter() the question was asked at
+        usage: The tokens spent on the answer
+        answer: The answer, or None if there wasn't one
+        moderation: The moderation errors, an empty list if the question passed,
+            or None if it wasn't moderated
+        session_id: The chat the turn belongs to, by default this process's
+        **fields: Anything else to record, such as an error or where the answer came from
+    """
+    if transcripts is None:
+        return
+    transcripts.record(
+        transcript_turn(
+            session_id,
+            question,
+            answer,
+            moderation,
+            latency=time.perf_counter() - start,
+            usage=usage,
+            profile=profile.name if profile is not None else None,
+            **fields,
+        )
+    )
 
 
 def main():
     os.system("cls" if os.name == "nt" else "clear")
     # keep track of previous questions and answers
-    previous_questions_and_answers = []
+    previous_questions_and_answers = new_history()
     while True:
         # ask the user for their question
         new_question = input(
             Fore.GREEN + Style.BRIGHT + "What can I get you?: " + Style.RESET_ALL
         )
-        # check the question is safe
-        errors = get_moderation(new_question)
+        start = time.perf_counter()
+        usage = {}
+        profile = None
+        try:
+            # check the question is safe and get the response, with the
+            # profile as it is now if the profiles file changed
+            profile = get_profile(PROFILE)
+            if profile is not None:
+                errors, response = get_moderated_response(
+                    profile.instructions, previous_questions_and_answers, new_question, profile.knowledge_base, profile, usage
+                )
+            else:
+                errors, response = get_moderated_response(
+                    INSTRUCTIONS, previous_questions_and_answers, new_question, usage=usage
+                )
+            if not errors:
+                # print the response
+                response = print_response("Here you go: ", response)
+        except API_ERRORS as error:
+            record_turn(new_question, profile, start, usage, error=str(error))
+            # keep the conversation going; the question can be asked again
+            print(Fore.RED + Style.BRIGHT + f"Sorry, something went wrong: {error}" + Style.RESET_ALL)
+            continue
+        record_turn(new_question, profile, start, usage, None if errors else response, errors or [])
         if errors:
             print(
                 Fore.RED
@@ -105,14 +816,10 @@ def main():
                 print(error)
             print(Style.RESET_ALL)
             continue
-        response = get_response(INSTRUCTIONS, previous_questions_and_answers, new_question)
 
         # add the new question and answer to the list of previous questions and answers
         previous_questions_and_answers.append((new_question, response))
 
-        # print the response
-        print(Fore.CYAN + Style.BRIGHT + "Here you go: " + Style.NORMAL + response)
-
 
 if __name__ == "__main__":
     main()
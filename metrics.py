@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# upper bounds of the token count histogram buckets
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """A value that only goes up, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, help):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.trace(self.name, amount, labels)
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, optionally split by labels"""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+        self.registry.trace(self.name, value, labels)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the body of a with statement takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        """Return how many values have been observed"""
+        return self._values.get(tuple(sorted(labels.items())), (None, 0.0, 0))[2]
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", labels + (("le", bound),), bucket_count
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    """Holds the metrics and exports them
+
+    Metrics are rendered in the Prometheus text format. With a trace file,
+    every increment and observation is also appended to it as a line of
+    JSON as it happens.
+    """
+
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+        self._trace = open(trace_path, "a", buffering=1, encoding="utf-8") if trace_path else None
+
+    def counter(self, name, help):
+        return self._metrics.setdefault(name, Counter(self, name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(self, name, help, buckets))
+
+    def collector(self, func):
+        """Register a function returning extra (name, kind, help, labels, value) samples
+
+        Collectors are called on every render, which suits values that are
+        kept elsewhere, such as the counters of a cache.
+        """
+        self._collectors.append(func)
+        return func
+
+    def trace(self, name, value, labels):
+        if self._trace is None:
+            return
+        event = {"time": time.time(), "metric": name, "value": value, **labels}
+        with self.lock:
+            self._trace.write(json.dumps(event) + "\n")
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for metric in self._metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        # the samples of a metric have to be listed together
+        families = {}
+        for collect in self._collectors:
+            for name, kind, help, labels, value in collect():
+                family = families.setdefault(name, [f"# HELP {name} {help}", f"# TYPE {name} {kind}"])
+                family.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        for family in families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
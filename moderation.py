@@ -0,0 +1,148 @@
+import functools
+import inspect
+import re
+
+from response_cache import ResponseCache
+from text import normalize
+
+MODERATION_ERRORS = {
+    "hate": "Content that expresses, incites, or promotes hate based on race, gender, ethnicity, religion, nationality, sexual orientation, disability status, or caste.",
+    "hate/threatening": "Hateful content that also includes violence or serious harm towards the targeted group.",
+    "self-harm": "Content that promotes, encourages, or depicts acts of self-harm, such as suicide, cutting, and eating disorders.",
+    "sexual": "Content meant to arouse sexual excitement, such as the description of sexual activity, or that promotes sexual services (excluding sex education and wellness).",
+    "sexual/minors": "Sexual content that includes an individual who is under 18 years old.",
+    "violence": "Content that promotes or glorifies violence or celebrates the suffering or humiliation of others.",
+    "violence/graphic": "Violent content that depicts death, violence, or serious physical injury in extreme graphic detail.",
+}
+
+
+def moderation_errors(result):
+    """
+    Turn a moderation result into the messages for its flagged categories
+
+    Parameters:
+        result (dict): One entry of the "results" list returned by the moderation endpoint
+
+    Returns a list of errors if the result is flagged, otherwise returns None
+    """
+    if not result["flagged"]:
+        return None
+    # get the categories that are flagged and generate a message
+    return [
+        error
+        for category, error in MODERATION_ERRORS.items()
+        if result["categories"].get(category)
+    ]
+
+
+# questions that are obviously safe, matched against the normalized text
+SAFE_PATTERNS = [
+    r"(hi|hello|hey|thanks|thank you|thank you very much|thx|ok|okay|yes|no|bye|goodbye|great|cool)",
+    # order, tracking and reference numbers on their own
+    r"(order|tracking|reference|ref)?( number| no| id)?( is)? ?[a-z]{0,3}\d[\d ]{3,}",
+]
+# phrases that always get flagged, by category, matched against the normalized text
+BLOCKED_PATTERNS = {
+    "violence": [
+        r"\b(i will|i ll|i m going to|i am going to|gonna) (kill|murder|stab|shoot) (you|him|her|them)\b",
+    ],
+}
+
+
+class Prescreen:
+    """Local check that settles the obvious cases before calling the API
+
+    Every pattern is compiled into a single regular expression, so the text
+    is scanned once however many patterns there are.
+    """
+
+    def __init__(self, safe_patterns=SAFE_PATTERNS, blocked_patterns=BLOCKED_PATTERNS):
+        self.safe = re.compile("|".join(f"(?:{pattern})" for pattern in safe_patterns))
+        self.categories = list(blocked_patterns)
+        self.blocked = re.compile("|".join(
+            f"(?P<g{number}>{'|'.join(patterns)})"
+            for number, patterns in enumerate(blocked_patterns.values())
+        )) if blocked_patterns else None
+
+    def __call__(self, text):
+        """
+        Screen a normalized question
+
+        Parameters:
+            text (str): The question, passed through text.normalize
+
+        Returns a tuple of whether the question was settled and, if it was,
+        the list of errors or None, as get_moderation would
+        """
+        if self.blocked is not None:
+            flagged = {
+                self.categories[int(group[1:])]
+                for match in self.blocked.finditer(text)
+                for group, value in match.groupdict().items()
+                if value is not None
+            }
+            if flagged:
+                return True, [
+                    error for category, error in MODERATION_ERRORS.items() if category in flagged
+                ]
+        if self.safe.fullmatch(text):
+            return True, None
+        return False, None
+
+
+def moderation_cache(maxsize=4096, ttl=24 * 60 * 60, prescreen=None, flight=None):
+    """
+    Decorate a moderation function with a cache and an optional prescreen
+
+    Results are keyed on the normalized question, so repeats skip the API.
+    The decorated function keeps the contract of get_moderation and can be a
+    plain or a coroutine function.
+
+    Parameters:
+        maxsize (int): The most results to keep; the least recently used go first
+        ttl (float): Seconds a result stays valid, or None to keep it forever
+        prescreen (Prescreen): Optional local check to run before the cache
+        flight (SingleFlight): Optional SingleFlight, or server.AsyncSingleFlight for a
+            coroutine function, so concurrent misses for a question share one call
+
+    Returns a decorator; the decorated function has a `cache` attribute
+    """
+    cache = ResponseCache(maxsize=maxsize, ttl=ttl)
+
+    def lookup(question):
+        text = normalize(question)
+        if prescreen is not None:
+            settled, errors = prescreen(text)
+            if settled:
+                return text, (errors,)
+        return text, cache.get(text)
+
+    def decorator(get_moderation):
+        if inspect.iscoroutinefunction(get_moderation):
+            @functools.wraps(get_moderation)
+            async def wrapper(question):
+                text, hit = lookup(question)
+                if hit is not None:
+                    return hit[0]
+                if flight is not None:
+                    errors = await flight.do(text, get_moderation, question)
+                else:
+                    errors = await get_moderation(question)
+                cache.set(text, (errors,))
+                return errors
+        else:
+            @functools.wraps(get_moderation)
+            def wrapper(question):
+                text, hit = lookup(question)
+                if hit is not None:
+                    return hit[0]
+                if flight is not None:
+                    errors = flight.do(text, get_moderation, question)
+                else:
+                    errors = get_moderation(question)
+                cache.set(text, (errors,))
+                return errors
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -0,0 +1,117 @@
+import threading
+
+
+class APIError(Exception):
+    """Raised when a call to the API fails
+
+    Attributes:
+        headers: The response headers, if the API answered, so a scheduler
+            can honour Retry-After
+    """
+
+    def __init__(self, message, headers=None):
+        super().__init__(message)
+        self.headers = headers or {}
+
+
+class RetryableAPIError(APIError):
+    """Raised for rate limits, timeouts and server errors, which are worth retrying"""
+
+
+class RateLimitError(RetryableAPIError):
+    """Raised when the API turns a call down because of a rate limit"""
+
+
+# the SDK errors worth retrying, by name in openai.error
+RETRYABLE_SDK_ERRORS = (
+    "RateLimitError",
+    "APIError",
+    "Timeout",
+    "ServiceUnavailableError",
+    "APIConnectionError",
+)
+
+
+class DeferredOpenAI:
+    """The openai SDK, imported and configured the first time it is used
+
+    Importing the SDK pulls in requests, aiohttp and their dependencies,
+    which costs more than the rest of the chatbot put together, so commands
+    that never call the API, such as health checks and cached batch runs,
+    don't pay for it. SDK errors are raised as APIError or
+    RetryableAPIError so callers don't need the SDK to catch them.
+    """
+
+    def __init__(self, api_key=None, api_base=None):
+        """
+        Args:
+            api_key: The API key, by default the SDK reads OPENAI_API_KEY
+            api_base: The API URL, by default the SDK reads OPENAI_API_BASE
+        """
+        self.api_key = api_key
+        self.api_base = api_base
+        self._sdk = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._sdk is not None
+
+    def configure(self, api_key=None, api_base=None):
+        """Change the API key or URL, now or whenever the SDK is imported"""
+        if api_key is not None:
+            self.api_key = api_key
+        if api_base is not None:
+            self.api_base = api_base
+        if self._sdk is not None:
+            self._apply(self._sdk)
+
+    def _apply(self, sdk):
+        if self.api_key is not None:
+            sdk.api_key = self.api_key
+        if self.api_base is not None:
+            sdk.api_base = self.api_base
+
+    def sdk(self):
+        """Return the openai module, importing it on first use"""
+        if self._sdk is None:
+            with self._lock:
+                if self._sdk is None:
+                    import openai as sdk
+                    self._apply(sdk)
+                    self._retryable = tuple(getattr(sdk.error, name) for name in RETRYABLE_SDK_ERRORS)
+                    self._sdk = sdk
+        return self._sdk
+
+    def _translate(self, error):
+        headers = getattr(error, "headers", None)
+        if isinstance(error, self._sdk.error.RateLimitError):
+            return RateLimitError(str(error), headers)
+        if isinstance(error, self._retryable):
+            return RetryableAPIError(str(error), headers)
+        return APIError(str(error), headers)
+
+    def _call(self, func, kwargs):
+        sdk = self.sdk()
+        try:
+            result = func(sdk)(**kwargs)
+        except sdk.error.OpenAIError as error:
+            raise self._translate(error) from error
+        if kwargs.get("stream"):
+            return self._stream(sdk, result)
+        return result
+
+    def _stream(self, sdk, chunks):
+        # streamed responses can also fail part way through
+        try:
+            yield from chunks
+        except sdk.error.OpenAIError as error:
+            raise self._translate(error) from error
+
+    def chat_completion(self, **kwargs):
+        """Call openai.ChatCompletion.create"""
+        return self._call(lambda sdk: sdk.ChatCompletion.create, kwargs)
+
+    def moderation(self, **kwargs):
+        """Call openai.Moderation.create"""
+        return self._call(lambda sdk: sdk.Moderation.create, kwargs)
@@ -0,0 +1,88 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# the completion runs here while moderation runs on the calling thread
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="completion")
+
+# marks the end of a streamed response in the queue
+_DONE = object()
+
+
+def moderate_while_responding(moderate, respond):
+    """Run the moderation check and the completion at the same time
+
+    The completion is started in the background before the moderation check
+    so that a question only waits for the slower of the two calls. If the
+    question is flagged the completion is cancelled, or its result thrown
+    away if it is already running, so it is never returned.
+
+    Args:
+        moderate: Callable returning a list of errors, or None if the question is safe
+        respond: Callable returning the response text
+
+    Returns:
+        A tuple of the moderation errors and the response text; the response
+        is None if the question was flagged
+    """
+    future = _executor.submit(respond)
+    try:
+        errors = moderate()
+    except BaseException:
+        future.cancel()
+        raise
+    if errors:
+        future.cancel()
+        return errors, None
+    return None, future.result()
+
+
+def moderate_while_streaming(moderate, stream):
+    """Run the moderation check while the response is already streaming
+
+    Pieces of the response are buffered until the moderation check passes,
+    then handed over as they arrive. If the question is flagged the stream
+    is abandoned and nothing that was buffered is returned.
+
+    Args:
+        moderate: Callable returning a list of errors, or None if the question is safe
+        stream: Callable returning an iterator over pieces of the response text
+
+    Returns:
+        A tuple of the moderation errors and an iterator over the pieces of
+        the response; the iterator is None if the question was flagged
+    """
+    pieces = queue.Queue()
+    cancelled = threading.Event()
+
+    def pump():
+        try:
+            for piece in stream():
+                if cancelled.is_set():
+                    break
+                pieces.put(piece)
+        except BaseException as error:
+            pieces.put(error)
+        finally:
+            pieces.put(_DONE)
+
+    _executor.submit(pump)
+    try:
+        errors = moderate()
+    except BaseException:
+        cancelled.set()
+        raise
+    if errors:
+        cancelled.set()
+        return errors, None
+    return None, _drain(pieces)
+
+
+def _drain(pieces):
+    while True:
+        piece = pieces.get()
+        if piece is _DONE:
+            return
+        if isinstance(piece, BaseException):
+            raise piece
+        yield piece
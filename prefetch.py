@@ -0,0 +1,192 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from response_cache import cache_key
+from scheduler import TokenBucket
+from text import normalize
+
+# how much the FAQ entries just before and after a question count as its follow-ups
+ADJACENT_WEIGHT = 0.2
+# how much follow-ups seen in real conversations count, on top of the FAQ
+OBSERVED_WEIGHT = 1.0
+# FAQ questions at least this similar are the same question, not a follow-up
+DUPLICATE_SIMILARITY = 0.95
+
+
+class FollowUps:
+    """Predicts which FAQ questions a customer is likely to ask next
+
+    Starts from how the FAQ questions relate to each other: how similar
+    their n-grams are, and whether they sit next to each other in the FAQ,
+    which keeps questions about the same topic together. Follow-ups seen in
+    real conversations are counted on top, so common flows such as tracking
+    a shipment and then asking what to do if it is lost rise to the top as
+    the bot is used.
+    """
+
+    def __init__(self, index, min_match=0.5):
+        """
+        Args:
+            index: The FaqIndex of the FAQ
+            min_match: How similar a question must be to an FAQ question to count as it
+        """
+        self.index = index
+        self.min_match = min_match
+        matrix = np.asarray(index.matrix)
+        self.similarity = matrix @ matrix.T
+        rows = np.arange(len(index) - 1)
+        self.prior = self.similarity.copy()
+        self.prior[rows, rows + 1] += ADJACENT_WEIGHT
+        self.prior[rows + 1, rows] += ADJACENT_WEIGHT
+        self.counts = np.zeros_like(self.similarity)
+        self._lock = threading.Lock()
+
+    def nearest(self, question):
+        """Return the row of the FAQ question a question is, or None if it isn't one"""
+        results = self.index.search(question, k=1)
+        if results and results[0][1] >= self.min_match:
+            return results[0][0]
+        return None
+
+    def observe(self, previous_question, question):
+        """Count a follow-up seen in a conversation"""
+        previous, row = self.nearest(previous_question), self.nearest(question)
+        if previous is not None and row is not None and previous != row:
+            with self._lock:
+                self.counts[previous, row] += 1
+
+    def predict(self, question, k=2):
+        """Return the k FAQ questions most likely to follow a question, best first"""
+        row = self.nearest(question)
+        if row is None:
+            return []
+        with self._lock:
+            counts = self.counts[row].copy()
+        scores = self.prior[row] + OBSERVED_WEIGHT * counts / max(counts.sum(), 1)
+        # rule out asking the same thing again
+        scores[self.similarity[row] >= DUPLICATE_SIMILARITY] = 0
+        questions = []
+        for candidate in np.argsort(-scores):
+            if len(questions) == k or scores[candidate] <= 0:
+                break
+            question = self.index.questions[candidate]
+            # the FAQ lists some questions more than once
+            if normalize(question) not in map(normalize, questions):
+                questions.append(question)
+        return questions
+
+
+class Prefetcher:
+    """Answers likely follow-up questions while the customer is typing
+
+    The answers are worked out on a single background thread, at most
+    `per_turn` a turn and `budget` an hour, and only while `ready` says
+    there is room for them. cancel() stops the work as soon as the next
+    real question comes in, so speculative calls never hold it up.
+
+    It is off unless a chat loop sets it up. The follow-ups are FAQ
+    questions, so it only pays off in a loop that sends FAQ questions to
+    the model; test.py answers them from the FAQ index and doesn't use it.
+
+    Attributes:
+        answered: How many follow-ups were answered ahead of time
+        used: How many of those answers were given to a customer
+        cancelled: How many were cut short by a real question
+        over_budget: How many were skipped because the budget was spent
+    """
+
+    def __init__(self, followups, answer, per_turn=2, budget=60, ready=None, key=cache_key):
+        """
+        Args:
+            followups: The FollowUps to predict questions with
+            answer: Callable taking the messages of a question and an Event that is
+                set on cancel, and returning the answer or None
+            per_turn: The most follow-ups to answer after each turn
+            budget: The most follow-ups to answer an hour, or None for no limit
+            ready: Optional callable returning False while speculative calls should wait
+            key: Callable turning messages into the key of their request, such as
+                response_cache.cache_key with the model parameters
+        """
+        self.followups = followups
+        self.answer = answer
+        self.per_turn = per_turn
+        self.budget = TokenBucket(budget / 3600, budget) if budget else None
+        self.ready = ready
+        self.key = key
+        self.answered = 0
+        self.used = 0
+        self.cancelled = 0
+        self.over_budget = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._cancel = threading.Event()
+        # answers for the next turn, by the key of their request
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, question, build_messages):
+        """Start answering the likely follow-ups to a question
+
+        Args:
+            question: The question that was just answered
+            build_messages: Callable turning a follow-up question into the
+                messages its real request would send
+        """
+        self.cancel()
+        cancel = threading.Event()
+        with self._lock:
+            self._cancel = cancel
+            self._answers = {}
+        jobs = [(followup, build_messages(followup)) for followup in self.followups.predict(question, self.per_turn)]
+        if jobs:
+            self._executor.submit(self._run, jobs, cancel)
+
+    def cancel(self):
+        """Stop answering follow-ups; answers already worked out are kept for take"""
+        self._cancel.set()
+
+    def take(self, messages):
+        """Return the answer worked out for a request, or None
+
+        Only a request with the same key as a prefetched one gets its answer;
+        a question that is merely similar to a predicted one may be asking
+        something else.
+
+        Args:
+            messages: The messages the real request sends
+        """
+        with self._lock:
+            answer = self._answers.pop(self.key(messages), None)
+        if answer is not None:
+            self.used += 1
+        return answer
+
+    def _run(self, jobs, cancel):
+        for question, messages in jobs:
+            if cancel.is_set() or (self.ready is not None and not self.ready()):
+                return
+            if self.budget is not None and not self.budget.try_acquire():
+                self.over_budget += 1
+                return
+            try:
+                answer = self.answer(messages, cancel)
+            except Exception:
+                # speculative work is best effort; the real question will be asked again
+                return
+            if answer is None:
+                if cancel.is_set():
+                    self.cancelled += 1
+                    return
+                continue
+            with self._lock:
+                # answers worked out for an earlier turn are out of date
+                if cancel is not self._cancel:
+                    return
+                self._answers[self.key(messages)] = answer
+            self.answered += 1
+
+    def collect_metrics(self):
+        """Report the counters, for metrics.Registry.collector"""
+        for outcome in ("answered", "used", "cancelled", "over_budget"):
+            yield "chatbot_prefetch_total", "counter", "Follow-up questions answered ahead of time, by outcome", {"outcome": outcome}, getattr(self, outcome)
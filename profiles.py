@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+
+from cascade import Cascade
+from prompt import message_tokens
+
+# the model parameters a profile can set, sent with every completion
+PARAMETERS = ("model", "temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty")
+# the other settings a profile can have
+SETTINGS = ("instructions", "max_context_questions", "knowledge_base", "tiers", "min_retrieval_score")
+# seconds between checks of whether the files changed
+CHECK_INTERVAL = 1.0
+
+
+class Profile:
+    """The instructions, model parameters and knowledge base of one brand
+
+    Everything that only depends on the profile, such as the completion
+    parameters and the token count of the instructions, is worked out once
+    when the profile is loaded rather than for every question.
+    """
+
+    def __init__(self, name, instructions, params, max_context_questions, knowledge_base=None, cascade=None):
+        """
+        Args:
+            name: The name sessions pick the profile by
+            instructions: The instructions for the chat bot
+            params: The model parameters, as sent to ChatCompletion
+            max_context_questions: How many turns of the chat are sent with a question
+            knowledge_base: Optional FaqIndex to pick relevant questions and answers from
+            cascade: The Cascade of model tiers the questions go through
+        """
+        self.name = name
+        self.instructions = instructions
+        self.params = params
+        self.max_context_questions = max_context_questions
+        self.knowledge_base = knowledge_base
+        self.cascade = cascade
+        self.instruction_tokens = message_tokens(instructions)
+
+
+class ProfileRegistry:
+    """Profiles read from a JSON file, reloaded when it changes
+
+    The file maps profile names to their settings under "profiles", and
+    names the profile sessions get by default under "default":
+
+        {"default": "shop", "profiles": {"shop": {
+            "instructions": "...", "temperature": 0.5, "knowledge_base": "faq.json"}}}
+
+    Settings a profile leaves out are taken from `defaults`. Knowledge base
+    paths are relative to the file, and profiles using the same knowledge
+    base share its index. The file and the knowledge bases are checked for
+    changes at most every `check_interval` seconds; a file that fails to
+    load leaves the profiles as they were, so a bad edit never takes the
+    bot down.
+
+    Attributes:
+        reloads: How often the profiles were reloaded after a change
+        errors: How often a changed file failed to load
+        error: The last load error, or None if the last load worked
+    """
+
+    def __init__(self, path, defaults, check_interval=CHECK_INTERVAL):
+        """
+        Args:
+            path: The profiles JSON file
+            defaults: The settings profiles leave out, including every model parameter
+            check_interval: Seconds between checks of whether the files changed
+        """
+        self.path = path
+        self.defaults = defaults
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.errors = 0
+        self.error = None
+        self._lock = threading.Lock()
+        # the FaqIndex of each knowledge base file, with the stamp it was loaded at
+        self._knowledge_bases = {}
+        self._checked = time.monotonic()
+        # a broken file at startup is a mistake worth failing on
+        self._profiles, self._default, self._stamps = self._load()
+
+    def __contains__(self, name):
+        return name in self._profiles
+
+    def names(self):
+        return list(self._profiles)
+
+    def get(self, name=None):
+        """Return a profile, reloading the profiles first if a file changed
+
+        Args:
+            name: The profile's name, or None for the default profile
+
+        Returns:
+            The Profile
+
+        Raises:
+            KeyError: If there is no profile with the name
+        """
+        self.refresh()
+        return self._profiles[self._default if name is None else name]
+
+    def refresh(self):
+        """Reload the profiles if a file changed since they were loaded"""
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            if all(_stamp(path) == stamp for path, stamp in self._stamps.items()):
+                return
+            try:
+                loaded = self._load()
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                self.errors += 1
+                self.error = f"{type(error).__name__}: {error}"
+                # keep serving the old profiles, and try again on the next change
+                self._stamps = {path: _stamp(path) for path in self._stamps}
+                return
+            # swapped in one go, so a request never sees half the new profiles
+            self._profiles, self._default, self._stamps = loaded
+            self.reloads += 1
+            self.error = None
+
+    def _load(self):
+        stamps = {self.path: _stamp(self.path)}
+        with open(self.path, encoding="utf-8") as file:
+            config = json.load(file)
+        profiles = {}
+        for name, settings in config["profiles"].items():
+            unknown = settings.keys() - set(PARAMETERS) - set(SETTINGS)
+            if unknown:
+                raise ValueError(f"profile {name!r} has unknown settings {sorted(unknown)}")
+            settings = {**self.defaults, **settings}
+            knowledge_base = None
+            if settings.get("knowledge_base"):
+                source = os.path.join(os.path.dirname(os.path.abspath(self.path)), settings["knowledge_base"])
+                knowledge_base = self._knowledge_base(source)
+                stamps[source] = _stamp(source)
+            profiles[name] = Profile(
+                name,
+                settings["instructions"],
+                {parameter: settings[parameter] for parameter in PARAMETERS},
+                settings["max_context_questions"],
+                knowledge_base,
+                Cascade(settings["tiers"], min_retrieval_score=settings.get("min_retrieval_score")),
+            )
+        default = config.get("default") or next(iter(profiles), None)
+        if default not in profiles:
+            raise ValueError(f"the default profile {default!r} doesn't exist")
+        return profiles, default, stamps
+
+    def _knowledge_base(self, source):
+        stamp = _stamp(source)
+        loaded = self._knowledge_bases.get(source)
+        if loaded is None or loaded[0] != stamp:
+            # imported here so profiles without a knowledge base don't load NumPy
+            from faq_index import load_knowledge_base
+
+            loaded = self._knowledge_bases[source] = stamp, load_knowledge_base(
+                source, os.path.splitext(source)[0] + ".idx"
+            )
+        return loaded[1]
+
+    def collect_metrics(self):
+        """Report the reloads, for metrics.Registry.collector"""
+        yield "chatbot_profiles", "gauge", "Prompt profiles loaded", {}, len(self._profiles)
+        yield "chatbot_profile_reloads_total", "counter", "Reloads of the profiles after a file changed", {}, self.reloads
+        yield "chatbot_profile_reload_errors_total", "counter", "Changed profile files that failed to load", {}, self.errors
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,173 @@
+from functools import lru_cache
+
+# the model whose tokenizer we count with
+TOKENIZER_MODEL = "gpt-3.5-turbo"
+# every message costs a few tokens of framing on top of its content
+TOKENS_PER_MESSAGE = 4
+# the reply is primed with a few tokens of its own
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    # imported on first use, as loading tiktoken is slow
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        # the encoding files are downloaded on first use, so this can fail offline
+        return None
+
+
+def count_tokens(text, model=TOKENIZER_MODEL):
+    """Count the tokens in a piece of text
+
+    Falls back to roughly four characters per token when tiktoken is not
+    available.
+
+    Args:
+        text: The text to count
+        model: The model whose tokenizer to use
+
+    Returns:
+        The number of tokens
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def message_tokens(content):
+    """Count the tokens a single chat message adds to the prompt"""
+    return count_tokens(content) + TOKENS_PER_MESSAGE
+
+
+@lru_cache(maxsize=4096)
+def pair_tokens(pair):
+    """Count the tokens a question and answer add to the prompt
+
+    The count is cached per pair, so each turn only counts the messages it
+    has not seen before.
+
+    Args:
+        pair: A (question, answer) tuple
+
+    Returns:
+        The number of tokens for the user and assistant messages
+    """
+    question, answer = pair
+    return message_tokens(question) + message_tokens(answer)
+
+
+def relevant_pairs(knowledge_base, new_question, top_k):
+    """Find the knowledge base entries most relevant to a question
+
+    Args:
+        knowledge_base: A FaqIndex over the stored questions and answers
+        new_question: The new question to ask the bot
+        top_k: The maximum number of entries to return
+
+    Returns:
+        A list of (question, answer) tuples, most relevant first
+    """
+    return [
+        (knowledge_base.questions[row], knowledge_base.answers[row])
+        for row, score in knowledge_base.search(new_question, top_k)
+        # a zero score means the question shares no n-grams with the entry
+        if score > 0
+    ]
+
+
+def select_context(previous_questions_and_answers, new_question, knowledge_base=None, top_k=5, recent=10):
+    """Pick the questions and answers to send along with a new question
+
+    Rather than only the tail of the history, the prompt gets the knowledge
+    base entries that best match the new question as well as the most
+    recent turns of the conversation.
+
+    Args:
+        previous_questions_and_answers: Chat history
+        new_question: The new question to ask the bot
+        knowledge_base: An optional FaqIndex to retrieve entries from
+        top_k: How many knowledge base entries to include
+        recent: How many of the latest conversation turns to include
+
+    Returns:
+        A tuple of the retrieved (question, answer) pairs, most relevant
+        first, and the recent turns, oldest first
+    """
+    history = list(previous_questions_and_answers[-recent:]) if recent else []
+    if knowledge_base is None or not top_k:
+        return [], history
+    # skip entries the conversation already repeats
+    context = [
+        pair
+        for pair in relevant_pairs(knowledge_base, new_question, top_k)
+        if pair not in history
+    ]
+    return context, history
+
+
+def build_messages(
+    instructions, new_question, context=(), history=(), max_tokens=None, summary=None, instruction_tokens=None
+):
+    """Build the chat messages for a question within a token budget
+
+    The instructions, the summary of earlier turns, if there is one, and the
+    new question are always sent. The remaining
+    budget goes to the recent history, newest turn first, and then to the
+    retrieved context, most relevant entry first. Whatever does not fit is
+    left out.
+
+    Args:
+        instructions: The instructions for the chat bot
+        new_question: The new question to ask the bot
+        context: Retrieved (question, answer) pairs, most relevant first
+        history: Recent (question, answer) pairs, oldest first
+        max_tokens: The token budget for the prompt, or None for no limit
+        summary: Optional summary of the turns that are no longer in the history
+        instruction_tokens: The tokens the instructions add, if already counted
+
+    Returns:
+        The list of messages to send to ChatCompletion
+    """
+    budget = float("inf") if max_tokens is None else max_tokens
+    if instruction_tokens is None:
+        instruction_tokens = message_tokens(instructions)
+    used = instruction_tokens + message_tokens(new_question) + TOKENS_PER_REPLY
+    if summary:
+        used += message_tokens(summary)
+    # the most recent turns matter most, so fill the budget from the end and
+    # stop at the first turn that doesn't fit to keep the history contiguous
+    kept_history = []
+    for pair in reversed(history):
+        tokens = pair_tokens(tuple(pair))
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept_history.append(pair)
+    kept_history.reverse()
+    # retrieved entries are independent, so a long one can be skipped in
+    # favour of shorter, less relevant ones
+    kept_context = []
+    for pair in context:
+        tokens = pair_tokens(tuple(pair))
+        if used + tokens > budget:
+            continue
+        used += tokens
+        kept_context.append(pair)
+
+    messages = [
+        { "role": "system", "content": instructions },
+    ]
+    if summary:
+        messages.append({ "role": "system", "content": summary })
+    for question, answer in kept_context + kept_history:
+        messages.append({ "role": "user", "content": question })
+        messages.append({ "role": "assistant", "content": answer })
+    messages.append({ "role": "user", "content": new_question })
+    return messages
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from text import normalize
+
+
+def cache_key(messages, **params):
+    """Fingerprint a request to ChatCompletion
+
+    The key covers the instructions, the context that was actually sent, the
+    model parameters and the normalized text of the new question, so two
+    requests only share a key when they would get the same kind of answer.
+
+    Args:
+        messages: The messages that would be sent, ending with the new question
+        **params: The model parameters, such as temperature and max_tokens
+
+    Returns:
+        A hex digest to look the response up by
+    """
+    *context, question = messages
+    payload = json.dumps(
+        [context, normalize(question["content"]), params],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """In-memory response cache with LRU eviction and a time to live
+
+    Attributes:
+        hits: How many lookups found a fresh response
+        misses: How many lookups found nothing, or only an expired response
+    """
+
+    def __init__(self, maxsize=1024, ttl=24 * 60 * 60):
+        """
+        Args:
+            maxsize: The most responses to keep; the least recently used go first
+            ttl: Seconds a response stays valid, or None to keep it forever
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """Check for a fresh response without counting a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key) or self._load(key)
+            return entry is not None and not self._expired(entry[1])
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """Look up a response
+
+        Returns:
+            The cached response text, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+            if entry is not None and self._expired(entry[1]):
+                self._delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, response):
+        """Store a response"""
+        with self._lock:
+            entry = (response, time.time())
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._store(key, entry)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the size and hit/miss counters of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+
+    # the in-memory cache has nothing behind it; subclasses add a backend
+
+    def _load(self, key):
+        return None
+
+    def _store(self, key, entry):
+        pass
+
+
+class SqliteResponseCache(ResponseCache):
+    """Response cache that is also written through to SQLite
+
+    The most recently used responses stay in memory as in ResponseCache; the
+    database keeps up to maxsize responses across restarts.
+    """
+
+    def __init__(self, path, maxsize=1024, ttl=24 * 60 * 60):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses"
+            " (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        if ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+        self._db.commit()
+
+    def _load(self, key):
+        row = self._db.execute(
+            "SELECT response, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def _store(self, key, entry):
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+            (key, *entry),
+        )
+        # keep the table to maxsize rows, dropping the oldest
+        self._db.execute(
+            "DELETE FROM responses WHERE key NOT IN"
+            " (SELECT key FROM responses ORDER BY created DESC LIMIT ?)",
+            (self.maxsize,),
+        )
+        self._db.commit()
+
+    def _delete(self, key):
+        super()._delete(key)
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._db.commit()
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,327 @@
+import random
+import threading
+import time
+
+# seconds between checks of whether the trial call of a half-open circuit is done
+TRIAL_POLL_INTERVAL = 0.25
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open
+
+    Attributes:
+        retry_after: Seconds until a call may be let through again
+    """
+
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket
+
+    Tokens are added continuously at `rate` per second up to `capacity`;
+    acquiring more tokens than are available blocks until they have been
+    added.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, limit):
+        """A bucket allowing `limit` tokens a minute, in bursts of up to a minute's worth"""
+        return cls(limit / 60, limit)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount=1):
+        """Take tokens from the bucket only if they are there now
+
+        Returns:
+            Whether the tokens were taken
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def fill(self):
+        """Return how full the bucket is, from 0 to 1"""
+        with self._lock:
+            self._refill()
+            return self.tokens / self.capacity
+
+    def _take(self, amount):
+        # returns how long to wait for the tokens, or 0 once they are taken
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        """Take tokens from the bucket, waiting for them if necessary
+
+        Returns:
+            The number of seconds spent waiting
+        """
+        # a request larger than the bucket could never go through otherwise
+        amount = min(amount, self.capacity)
+        waited = 0
+        while delay := self._take(amount):
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    async def acquire_async(self, amount=1):
+        """Like acquire, waiting without blocking the event loop"""
+        import asyncio
+        amount = min(amount, self.capacity)
+        waited = 0
+        while delay := self._take(amount):
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+
+class CircuitBreaker:
+    """Stops calling a failing API for a while instead of piling on retries
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    fail straight away with CircuitOpenError. Once `reset_timeout` seconds
+    have passed, one trial call is let through: if it succeeds the circuit
+    closes again, otherwise it stays open for another `reset_timeout`.
+
+    Only failures of the API itself count; a rate limit means the API is
+    up but busy, which backing off deals with.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return
+            if state == "half-open":
+                retry_after = TRIAL_POLL_INTERVAL
+            else:
+                retry_after = self.reset_timeout - (time.monotonic() - self.opened_at)
+            raise CircuitOpenError("the API is failing; not calling it for now", retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_abandoned(self):
+        """Let another trial call through if a call was given up on before it finished"""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class Scheduler:
+    """Rate limits, retries and guards calls to the API
+
+    Every call waits for the requests-per-minute and tokens-per-minute
+    buckets, passes the circuit breaker, and is retried with exponential
+    backoff and full jitter when it fails with one of the `retryable`
+    exceptions. While the circuit is open, calls wait for it to let them
+    through, up to `circuit_wait` seconds, rather than all failing at once.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        retryable=(),
+        rate_limited=(),
+        max_retries=5,
+        backoff_base=1,
+        backoff_max=60,
+        timeout=None,
+        timeout_argument="request_timeout",
+        breaker=None,
+        circuit_wait=None,
+        sleep=time.sleep,
+    ):
+        """
+        Args:
+            requests_per_minute: The request limit, or None for no limit
+            tokens_per_minute: The token limit, or None for no limit
+            retryable: The exception types worth retrying
+            rate_limited: The retryable exception types that mean the API is
+                busy rather than failing, which don't count toward the circuit breaker
+            max_retries: How often a call is retried before giving up
+            backoff_base: Seconds to wait at most before the first retry; doubled for every retry after
+            backoff_max: The most seconds to wait before any retry
+            timeout: Seconds before a single attempt is given up on, or None
+            timeout_argument: The keyword the timeout is passed to the API call as
+            breaker: The CircuitBreaker to use, by default a new one
+            circuit_wait: The most seconds a call waits for an open circuit,
+                by default twice the breaker's reset_timeout, enough for the
+                circuit to let a trial call through and for it to succeed
+            sleep: Function used to wait between retries
+        """
+        self.requests = TokenBucket.per_minute(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket.per_minute(tokens_per_minute) if tokens_per_minute else None
+        self.retryable = tuple(retryable)
+        self.rate_limited = tuple(rate_limited)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.timeout_argument = timeout_argument
+        self.breaker = breaker or CircuitBreaker()
+        self.circuit_wait = 2 * self.breaker.reset_timeout if circuit_wait is None else circuit_wait
+        self.sleep = sleep
+        self.retries = 0
+
+    def headroom(self):
+        """Return the share of the rate limits that is free right now, from 0 to 1
+
+        Optional work can check this so it doesn't hold up calls that matter.
+        """
+        if self.breaker.state == "open":
+            return 0.0
+        buckets = [bucket for bucket in (self.requests, self.tokens) if bucket is not None]
+        return min((bucket.fill() for bucket in buckets), default=1.0)
+
+    def backoff(self, attempt, error):
+        """Return how long to wait before retrying after a failed attempt"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        # rate limit errors may tell us how long to wait
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        if retry_after:
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def _circuit_delay(self, waited):
+        """Return how long to wait for the circuit, or raise CircuitOpenError if it is too long"""
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as error:
+            if waited + error.retry_after > self.circuit_wait:
+                raise
+            return error.retry_after
+        return 0
+
+    def _failed(self, attempt, error):
+        """Record a failed attempt, and return how long to wait before the next one"""
+        if isinstance(error, self.rate_limited):
+            # the API answered; it is busy, not down
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        if attempt == self.max_retries:
+            raise error
+        self.retries += 1
+        return self.backoff(attempt, error)
+
+    def call(self, func, *args, tokens=0, timeout=True, **kwargs):
+        """Call `func` with the rate limits, retries and circuit breaker applied
+
+        Args:
+            func: The API call, such as DeferredOpenAI.chat_completion
+            *args: Passed on to func
+            tokens: How many tokens the call will use, for the tokens-per-minute limit
+            timeout: False for calls that don't take a timeout argument
+            **kwargs: Passed on to func
+
+        Returns:
+            Whatever func returns
+        """
+        if timeout and self.timeout is not None:
+            kwargs.setdefault(self.timeout_argument, self.timeout)
+        waited = 0
+        for attempt in range(self.max_retries + 1):
+            while delay := self._circuit_delay(waited):
+                self.sleep(delay)
+                waited += delay
+            if self.requests is not None:
+                self.requests.acquire()
+            if self.tokens is not None and tokens:
+                self.tokens.acquire(tokens)
+            try:
+                result = func(*args, **kwargs)
+            except self.retryable as error:
+                self.sleep(self._failed(attempt, error))
+            except Exception:
+                # the API answered, even if it didn't like the request
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                self.breaker.record_abandoned()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def call_async(self, func, *args, tokens=0, timeout=True, **kwargs):
+        """Like call, for a coroutine function, waiting without blocking the event loop"""
+        import asyncio
+        if timeout and self.timeout is not None:
+            kwargs.setdefault(self.timeout_argument, self.timeout)
+        waited = 0
+        for attempt in range(self.max_retries + 1):
+            while delay := self._circuit_delay(waited):
+                await asyncio.sleep(delay)
+                waited += delay
+            if self.requests is not None:
+                await self.requests.acquire_async()
+            if self.tokens is not None and tokens:
+                await self.tokens.acquire_async(tokens)
+            try:
+                result = await func(*args, **kwargs)
+            except self.retryable as error:
+                await asyncio.sleep(self._failed(attempt, error))
+            except Exception:
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # such as the request being cancelled, which says nothing about the API
+                self.breaker.record_abandoned()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
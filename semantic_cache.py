@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+import zlib
+
+from text import char_ngrams, normalize
+
+
+class HashingEmbedder:
+    """Embed text offline by hashing its character n-grams
+
+    Each n-gram is hashed to one of `dim` buckets with a random sign, so
+    texts that share many n-grams end up with a high cosine similarity. No
+    vocabulary or model is needed.
+    """
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def __call__(self, text):
+        import numpy as np
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for gram in char_ngrams(normalize(text)):
+            # crc32 rather than hash() so vectors are the same in every process
+            digest = zlib.crc32(gram.encode())
+            vector[digest % self.dim] += 1 if digest & 0x80000000 else -1
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """Response cache that also answers differently worded repeats
+
+    Questions are embedded with a pluggable embedder and stored as rows of
+    a preallocated NumPy matrix; a lookup is a single matrix-vector product
+    over the stored rows. The best match is returned if its cosine
+    similarity reaches `threshold` and it was stored under the same
+    namespace, such as the same instructions and model parameters.
+
+    When the cache is full the least recently used entry is overwritten.
+
+    Attributes:
+        hits: How many lookups found a similar enough question
+        misses: How many lookups found nothing
+    """
+
+    def __init__(self, embed=None, threshold=0.9, maxsize=1024, ttl=24 * 60 * 60):
+        """
+        Args:
+            embed: Callable turning text into a unit vector, by default a HashingEmbedder
+            threshold: The minimum cosine similarity for a hit
+            maxsize: The most questions to keep
+            ttl: Seconds an answer stays valid, or None to keep it forever
+        """
+        self.embed = embed or HashingEmbedder()
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # allocated on the first set, so importing the cache doesn't load NumPy
+        self._matrix = None
+        self._answers = [None] * maxsize
+        self._namespaces = None
+        self._created = None
+        self._used = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _namespace_id(self, namespace):
+        # hashed rather than numbered, so a namespace per conversation doesn't pile up ids
+        digest = hashlib.blake2b(namespace.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    def get(self, question, namespace=""):
+        """Look up the answer to the most similar stored question
+
+        Returns:
+            The cached answer, or None on a miss
+        """
+        vector = self.embed(question)
+        with self._lock:
+            if self._size:
+                scores = self._matrix[: self._size] @ vector
+                # rule out entries from other namespaces and expired ones
+                scores[self._namespaces[: self._size] != self._namespace_id(namespace)] = -1
+                if self.ttl is not None:
+                    scores[time.time() - self._created[: self._size] > self.ttl] = -1
+                row = int(scores.argmax())
+                if scores[row] >= self.threshold:
+                    self._used[row] = time.monotonic()
+                    self.hits += 1
+                    return self._answers[row]
+            self.misses += 1
+            return None
+
+    def set(self, question, answer, namespace=""):
+        """Store the answer to a question"""
+        import numpy as np
+
+        vector = self.embed(question)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+                self._namespaces = np.full(self.maxsize, -1, dtype=np.int64)
+                self._created = np.zeros(self.maxsize)
+                self._used = np.zeros(self.maxsize)
+            if self._size < self.maxsize:
+                row = self._size
+                self._size += 1
+            else:
+                row = int(self._used.argmin())
+            self._matrix[row] = vector
+            self._answers[row] = answer
+            self._namespaces[row] = self._namespace_id(namespace)
+            self._created[row] = time.time()
+            self._used[row] = time.monotonic()
+
+    def stats(self):
+        """Return the size and hit/miss counters of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
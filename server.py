@@ -0,0 +1,668 @@
+"""Serve the chat bot to many customers at once over HTTP and WebSocket
+
+    POST /sessions/{session_id}/messages  {"question": "..."}
+        -> {"answer": "..."} or, with status 400, {"errors": [...]} for a
+        flagged question or a bad request, or with status 502 if the API failed
+        the body may name a prompt profile, {"question": "...", "profile": "..."}
+    GET  /sessions/{session_id}/ws
+        each text frame is a question; the answer comes back as
+        {"type": "delta", "content": "..."} frames and a {"type": "done"} frame,
+        or a single {"type": "moderation", "errors": [...]} frame; if the API
+        fails, {"type": "error", "errors": [...]} ends the answer and the
+        question can be asked again
+    DELETE /sessions/{session_id}
+    GET /metrics
+        latency, token and cache metrics in the Prometheus text format
+
+With --profiles, or PROFILES_PATH, one server hosts several brands: a
+request picks its prompt profile with "profile" in the JSON body, or with
+?profile= on the WebSocket URL, and gets the default profile otherwise.
+The profiles file is reloaded when it changes.
+
+Set OPENAI_API_BASE to point the server at a local stub such as
+fake_openai.py, or --backend http and --api-base at a self-hosted model
+with an OpenAI-compatible API; --backend stub answers without a network.
+--moderation-backend, or MODERATION_BACKEND, moderates with another
+backend, for models served without /moderations. With --session-store,
+conversations are kept in a SQLite database, so they survive restarts and several server processes behind a
+load balancer can serve the same sessions.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict
+
+import aiohttp
+from aiohttp import web
+
+from main import (
+    API_ERRORS,
+    COALESCE_TIMEOUT,
+    INSTRUCTIONS,
+    LLM_API_BASE,
+    LLM_API_KEY,
+    LLM_BACKEND,
+    MAX_CONTEXT_QUESTIONS,
+    MODERATION_CACHE_SIZE,
+    MODERATION_BACKEND,
+    MODERATION_CACHE_TTL,
+    MODERATION_PRESCREEN,
+    PROFILE_DEFAULTS,
+    SUMMARY_THRESHOLD,
+    MeteredRun,
+    cache_response,
+    cascade_for,
+    completion_params,
+    completion_seconds,
+    first_tier,
+    flagged_questions,
+    get_cached_response,
+    get_messages,
+    get_summary,
+    moderation_seconds,
+    record_turn,
+    profiles,
+    registry,
+    scheduler,
+    semantic_namespace,
+)
+from backends import BACKENDS, HTTPBackend, create_backend
+from history import History
+from moderation import moderation_cache, moderation_errors
+from profiles import ProfileRegistry
+from prompt import count_tokens
+from response_cache import cache_key
+from session_store import SessionStore, SqliteSessionStore
+from singleflight import FlightAbandoned, FlightTimeout, SingleFlight
+from summary import RollingSummary
+
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+# how many connections to the API are kept open and shared by all sessions
+CONNECTION_POOL_SIZE = 100
+# seconds before a call to the API is given up on
+REQUEST_TIMEOUT = 60
+# how many turns of each session are read for the prompt, and kept by the
+# in-memory session store; older turns never reach the prompt, whatever a
+# profile's max_context_questions
+SESSION_HISTORY_SIZE = MAX_CONTEXT_QUESTIONS
+# sessions unused for this many seconds are forgotten, and so are the least
+# recently used ones beyond MAX_SESSIONS: their summaries, and their turns
+# too if they are in the in-memory session store
+SESSION_IDLE_TTL = 60 * 60
+MAX_SESSIONS = 10000
+
+
+def server_backend(name, api_base=None, api_key=None, pool_size=CONNECTION_POOL_SIZE):
+    """Create a backend for the server, one of backends.BACKENDS
+
+    The server talks to the OpenAI API over HTTP itself rather than through
+    the SDK, so "openai" is an HTTP backend for OPENAI_API_BASE.
+
+    Args:
+        name: The backend
+        api_base: The URL of the API, by default OPENAI_API_BASE for "openai"
+            and LLM_API_BASE for "http"
+        api_key: The API key, by default OPENAI_API_KEY for "openai" and
+            LLM_API_KEY for "http"
+        pool_size: How many connections to the API are kept open
+
+    Returns:
+        The Backend
+    """
+    if name == "openai":
+        return HTTPBackend(
+            api_base or OPENAI_API_BASE, api_key or os.getenv("OPENAI_API_KEY"), pool_size, REQUEST_TIMEOUT
+        )
+    if name == "http":
+        if not (api_base or LLM_API_BASE):
+            raise ValueError("the http backend needs the URL of the server")
+        return HTTPBackend(api_base or LLM_API_BASE, api_key or LLM_API_KEY, pool_size, REQUEST_TIMEOUT)
+    return create_backend(name)
+
+
+def create_backends(backend=LLM_BACKEND, moderation_backend=MODERATION_BACKEND, api_base=None, pool_size=CONNECTION_POOL_SIZE):
+    """Create the backends for chat completions and for moderation
+
+    Args:
+        backend: The backend answers come from
+        moderation_backend: The backend questions are moderated by
+        api_base: The URL of the API answers come from, instead of the default
+        pool_size: How many connections each backend keeps open
+
+    Returns:
+        A tuple of the two backends, the same one twice if they are the same
+    """
+    answers = server_backend(backend, api_base, pool_size=pool_size)
+    if moderation_backend == backend:
+        return answers, answers
+    return answers, server_backend(moderation_backend, pool_size=pool_size)
+
+
+class Session:
+    """One customer's conversation, kept in the session store
+
+    Turns too old for the prompt are folded into a running summary that is
+    sent instead, like the interactive chat's history does.
+    """
+
+    def __init__(self, store, session_id, summarize=get_summary):
+        self.store = store
+        self.session_id = session_id
+        self.summary = RollingSummary(summarize, threshold=SUMMARY_THRESHOLD, errors=API_ERRORS)
+        # turns of the same session are answered one at a time
+        self.lock = asyncio.Lock()
+        # when the session was last asked something
+        self.used = time.monotonic()
+
+    @property
+    def previous_questions_and_answers(self):
+        # a History of the stored turns, so get_messages sends the summary too
+        return History(SESSION_HISTORY_SIZE, summary=self.summary, store=self.store, session_id=self.session_id)
+
+    def add(self, question, answer):
+        """Store a turn, folding the one it pushes out of the prompt into the summary
+
+        Summarizing calls the API, so run this off the event loop.
+        """
+        turns = self.store.last(self.session_id, SESSION_HISTORY_SIZE)
+        self.store.append(self.session_id, (question, answer))
+        if len(turns) == SESSION_HISTORY_SIZE:
+            self.summary.add(turns[0])
+
+
+async def moderate_while_streaming(moderate, stream):
+    """Async counterpart of parallel.moderate_while_streaming
+
+    The completion streams into a queue while the moderation check runs and
+    is cancelled if the question is flagged.
+
+    Args:
+        moderate: Coroutine function returning the moderation errors
+        stream: Async generator function yielding pieces of the response
+
+    Returns:
+        A tuple of the moderation errors and an async iterator over the
+        pieces of the response; the iterator is None if the question was flagged
+    """
+    pieces = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for piece in stream():
+                pieces.put_nowait(piece)
+        except Exception as error:
+            pieces.put_nowait(error)
+        finally:
+            pieces.put_nowait(None)
+
+    streaming = asyncio.create_task(pump())
+    try:
+        errors = await moderate()
+    except BaseException:
+        streaming.cancel()
+        raise
+    if errors:
+        streaming.cancel()
+        return errors, None
+
+    async def drain():
+        while (piece := await pieces.get()) is not None:
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+
+    return None, drain()
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Async counterpart of singleflight.SingleFlight, for coroutines sharing an event loop
+
+    A caller that is cancelled while making the call hands it over: the
+    callers waiting for it make it again, and the first of them is shared.
+    """
+
+    def claim(self, key):
+        future = self._flights.get(key)
+        if future is not None:
+            self.shared += 1
+            return future, False
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        return future, True
+
+    def settle(self, key, future, result=None, error=None):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if error is not None:
+            future.set_exception(error)
+            # nobody may be waiting, which asyncio would otherwise log
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def wait(self, future):
+        try:
+            # a waiter timing out or being cancelled leaves the call running for the others
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise FlightTimeout(f"the shared call took more than {self.timeout} seconds") from None
+
+    async def do(self, key, func, *args, **kwargs):
+        """Await func, or wait for the call already in flight for the key"""
+        while True:
+            future, leader = self.claim(key)
+            if leader:
+                break
+            try:
+                return await self.wait(future)
+            except FlightAbandoned:
+                continue
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as error:
+            self.settle(key, future, error=error)
+            raise
+        except BaseException:
+            self.settle(key, future, error=FlightAbandoned())
+            raise
+        self.settle(key, future, result)
+        return result
+
+    async def stream(self, key, func, *args, **kwargs):
+        """Like SingleFlight.stream, for an async generator function"""
+        while True:
+            future, leader = self.claim(key)
+            if leader:
+                break
+            try:
+                yield await self.wait(future)
+                return
+            except FlightAbandoned:
+                continue
+        pieces = []
+        stream = func(*args, **kwargs)
+        try:
+            async for piece in stream:
+                pieces.append(piece)
+                yield piece
+        except Exception as error:
+            self.settle(key, future, error=error)
+            raise
+        except BaseException:
+            self.settle(key, future, error=FlightAbandoned())
+            raise
+        finally:
+            await stream.aclose()
+        self.settle(key, future, "".join(pieces))
+
+
+class ChatServer:
+    def __init__(
+        self,
+        backend,
+        moderation_backend=None,
+        instructions=INSTRUCTIONS,
+        knowledge_base=None,
+        store=None,
+        profiles=profiles,
+        scheduler=scheduler,
+    ):
+        self.backend = backend
+        self.moderation_backend = moderation_backend or backend
+        # the same rate limits, retries and circuit breaker as main's calls
+        self.scheduler = scheduler
+        self.instructions = instructions
+        self.knowledge_base = knowledge_base
+        # without profiles every request gets the instructions and knowledge base above
+        self.profiles = profiles
+        # sessions asking the same thing at the same time share one API call
+        self.moderation_flight = AsyncSingleFlight(COALESCE_TIMEOUT)
+        self.completion_flight = AsyncSingleFlight(COALESCE_TIMEOUT)
+        self.moderate = moderation_cache(
+            maxsize=MODERATION_CACHE_SIZE,
+            ttl=MODERATION_CACHE_TTL,
+            prescreen=MODERATION_PRESCREEN,
+            flight=self.moderation_flight,
+        )(self._moderate)
+        # a store is falsy while it has no sessions, so test for None
+        self.store = store if store is not None else SessionStore(
+            max_turns=SESSION_HISTORY_SIZE, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL
+        )
+        # sessions keep their summary between requests; least recently used first
+        self.sessions = OrderedDict()
+        registry.collector(self.collect_metrics)
+        if profiles is not None:
+            registry.collector(profiles.collect_metrics)
+
+    def collect_metrics(self):
+        stats = self.moderate.cache.stats()
+        yield "chatbot_cache_hits_total", "counter", "Cache lookups that found an entry", {"cache": "server_moderation"}, stats["hits"]
+        yield "chatbot_cache_misses_total", "counter", "Cache lookups that found nothing", {"cache": "server_moderation"}, stats["misses"]
+        yield "chatbot_cache_entries", "gauge", "Entries in the cache", {"cache": "server_moderation"}, stats["size"]
+        yield "chatbot_sessions", "gauge", "Sessions with a history", {}, len(self.store)
+        yield "chatbot_sessions_evicted_total", "counter", "Sessions forgotten for being idle or over the limit", {}, self.store.evicted
+        for name, flight in (("server_moderation", self.moderation_flight), ("server_completion", self.completion_flight)):
+            yield "chatbot_coalesced_requests_total", "counter", "Requests that shared another request's API call", {"call": name}, flight.shared
+
+    def session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            summarize = functools.partial(get_summary, summary_backend=self.backend)
+            session = self.sessions[session_id] = Session(self.store, session_id, summarize)
+        self.sessions.move_to_end(session_id)
+        session.used = time.monotonic()
+        self.forget_sessions()
+        return session
+
+    def forget_sessions(self):
+        """Drop the sessions that have been idle too long or are over MAX_SESSIONS"""
+        cutoff = time.monotonic() - SESSION_IDLE_TTL
+        forgotten = []
+        for session_id, session in self.sessions.items():
+            if len(self.sessions) - len(forgotten) <= MAX_SESSIONS and session.used >= cutoff:
+                break
+            # a session answering a question is kept, so its turns stay in order
+            if not session.lock.locked():
+                forgotten.append(session_id)
+        for session_id in forgotten:
+            del self.sessions[session_id]
+
+    def profile(self, name=None):
+        """Return the profile a request asked for, or None without profiles
+
+        Raises:
+            KeyError: If there is no profile with the name
+        """
+        if self.profiles is None:
+            if name is not None:
+                raise KeyError(name)
+            return None
+        return self.profiles.get(name)
+
+    def messages(self, session, question, profile=None):
+        if profile is not None:
+            return get_messages(
+                profile.instructions, session.previous_questions_and_answers, question, profile.knowledge_base, profile
+            )
+        return get_messages(
+            self.instructions, session.previous_questions_and_answers, question, self.knowledge_base
+        )
+
+    def namespace(self, session, profile=None):
+        """Return the semantic cache namespace of a session's next question"""
+        instructions = profile.instructions if profile is not None else self.instructions
+        return semantic_namespace(instructions, session.previous_questions_and_answers, profile)
+
+    def first_tier(self, messages, profile=None):
+        knowledge_base = profile.knowledge_base if profile is not None else self.knowledge_base
+        return first_tier(messages[-1]["content"], knowledge_base, profile)
+
+    def params(self, profile, tier):
+        """Return the model parameters of a profile's cascade tier"""
+        return {**completion_params(profile), **cascade_for(profile).tiers[tier]}
+
+    async def create_completion(self, messages, profile, tier, stream=False):
+        """Async version of main.create_completion, with the parameters of a cascade tier"""
+        params = self.params(profile, tier)
+        # the prompt and the longest possible reply count towards the token limit
+        tokens = sum(count_tokens(message["content"]) for message in messages) + params["max_tokens"]
+        call = self.backend.astream if stream else self.backend.acomplete
+        return await self.scheduler.call_async(call, messages, tokens=tokens, **params)
+
+    async def _moderate(self, question):
+        """Async version of main.get_moderation"""
+        with moderation_seconds.time():
+            result = await self.scheduler.call_async(self.moderation_backend.amoderate, question)
+        errors = moderation_errors(result)
+        if errors:
+            flagged_questions.inc()
+        return errors
+
+    async def check(self, question, moderated):
+        """Moderate a question, settling `moderated` with whether it passed, even if the check fails"""
+        passed = False
+        try:
+            errors = await self.moderate(question)
+            passed = not errors
+            return errors
+        finally:
+            moderated.set_result(passed)
+
+    async def complete(self, messages, profile=None, moderated=None, usage=None, namespace=None):
+        """Get the response text, from the cache if we have answered it before
+
+        Goes through the model cascade like main.get_response, and like it
+        shares the answer with concurrent requests for the same one. With a
+        `moderated` future, as set by check, the answer is only cached once
+        the question has passed. The tokens spent are added to `usage`, if given,
+        and `namespace` is passed on to main.get_cached_response.
+        """
+        answer = get_cached_response(messages, profile, namespace)
+        if answer is not None:
+            return answer
+        key = cache_key(messages, **completion_params(profile))
+        return await self.completion_flight.do(key, self._complete, messages, profile, moderated, usage, namespace)
+
+    async def _complete(self, messages, profile, moderated, usage, namespace):
+        run = MeteredRun(messages, self.first_tier(messages, profile), profile, usage)
+        while not run.done:
+            with completion_seconds.time(call="chat"):
+                completion = await self.create_completion(run.request, profile, run.tier)
+            run.answered(completion.text, completion.finish_reason, completion.usage)
+        answer = run.answer
+        if moderated is None or await moderated:
+            cache_response(messages, answer, profile, namespace)
+        return answer
+
+    async def stream(self, messages, profile=None, moderated=None, usage=None, namespace=None):
+        """Stream the response text, from the cache if we have answered it before
+
+        Goes through the model cascade like main.get_response_stream, and
+        like it shares the answer with concurrent requests for the same one.
+        Takes `moderated`, `usage` and `namespace` like complete.
+        """
+        answer = get_cached_response(messages, profile, namespace)
+        if answer is not None:
+            yield answer
+            return
+        key = cache_key(messages, **completion_params(profile))
+        async for piece in self.completion_flight.stream(
+            key, self._stream, messages, profile, moderated, usage, namespace
+        ):
+            yield piece
+
+    async def _stream(self, messages, profile, moderated, usage, namespace):
+        run = MeteredRun(messages, self.first_tier(messages, profile), profile, usage)
+        while not run.done:
+            stream = await self.create_completion(run.request, profile, run.tier, stream=True)
+            try:
+                async for content, finish in stream:
+                    piece = run.feed(content, finish)
+                    if piece:
+                        yield piece
+                    if run.stopped:
+                        break
+            finally:
+                # give the connection back now if the answer was cut off
+                await stream.aclose()
+            piece = run.end_attempt()
+            if piece:
+                yield piece
+        completion_seconds.observe(time.perf_counter() - run.start, call="chat")
+        answer = run.answer
+        if moderated is None or await moderated:
+            cache_response(messages, answer, profile, namespace)
+
+    async def post_message(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"errors": ["the body must be JSON"]}, status=400)
+        if not isinstance(body, dict) or not isinstance(body.get("question"), str) or not body["question"].strip():
+            return web.json_response({"errors": ["the body must have a \"question\""]}, status=400)
+        question = body["question"]
+        try:
+            profile = self.profile(body.get("profile"))
+        except (KeyError, TypeError):
+            return web.json_response({"errors": [f"unknown profile {body['profile']!r}"]}, status=400)
+        session_id = request.match_info["session_id"]
+        session = self.session(session_id)
+        async with session.lock:
+            start = time.perf_counter()
+            usage = {}
+            # the completion can finish before the check, but its answer waits for it to be cached
+            moderated = asyncio.get_running_loop().create_future()
+            completion = asyncio.create_task(
+                self.complete(
+                    self.messages(session, question, profile), profile, moderated, usage, self.namespace(session, profile)
+                )
+            )
+            try:
+                errors = await self.check(question, moderated)
+                if not errors:
+                    answer = await completion
+            except API_ERRORS as error:
+                completion.cancel()
+                record_turn(question, profile, start, usage, session_id=session_id, error=str(error))
+                return web.json_response({"errors": [f"the answer failed: {error}"]}, status=502)
+            except BaseException:
+                completion.cancel()
+                raise
+            if errors:
+                completion.cancel()
+                record_turn(question, profile, start, usage, moderation=errors, session_id=session_id)
+                return web.json_response({"errors": errors}, status=400)
+            record_turn(question, profile, start, usage, answer, moderation=[], session_id=session_id)
+            await asyncio.to_thread(session.add, question, answer)
+        return web.json_response({"answer": answer})
+
+    async def websocket(self, request):
+        try:
+            profile = self.profile(request.query.get("profile"))
+        except KeyError:
+            return web.json_response({"errors": [f"unknown profile {request.query['profile']!r}"]}, status=400)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session_id = request.match_info["session_id"]
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            question = message.data
+            if not question.strip():
+                await ws.send_json({"type": "error", "errors": ["the question is empty"]})
+                continue
+            session = self.session(session_id)
+            async with session.lock:
+                start = time.perf_counter()
+                usage = {}
+                messages = self.messages(session, question, profile)
+                namespace = self.namespace(session, profile)
+                moderated = asyncio.get_running_loop().create_future()
+                answer = []
+                try:
+                    errors, pieces = await moderate_while_streaming(
+                        lambda: self.check(question, moderated), lambda: self.stream(messages, profile, moderated, usage, namespace)
+                    )
+                    if errors:
+                        record_turn(question, profile, start, usage, moderation=errors, session_id=session_id)
+                        await ws.send_json({"type": "moderation", "errors": errors})
+                        continue
+                    async for piece in pieces:
+                        answer.append(piece)
+                        await ws.send_json({"type": "delta", "content": piece})
+                except API_ERRORS as error:
+                    record_turn(question, profile, start, usage, session_id=session_id, error=str(error))
+                    # the connection stays open for the next question
+                    await ws.send_json({"type": "error", "errors": [f"the answer failed: {error}"]})
+                    continue
+                answer = "".join(answer)
+                record_turn(question, profile, start, usage, answer, moderation=[], session_id=session_id)
+                await ws.send_json({"type": "done"})
+                await asyncio.to_thread(session.add, question, answer)
+        return ws
+
+    async def get_metrics(self, request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def delete_session(self, request):
+        self.store.delete(request.match_info["session_id"])
+        self.sessions.pop(request.match_info["session_id"], None)
+        return web.Response(status=204)
+
+
+def create_app(backend=None, moderation_backend=None, **kwargs):
+    """Create the web application
+
+    Args:
+        backend: The Backend answers come from, by default one for LLM_BACKEND
+        moderation_backend: The Backend questions are moderated by, by default
+            one for MODERATION_BACKEND, or the same as answers come from
+        **kwargs: Passed on to ChatServer
+
+    Returns:
+        The aiohttp application
+    """
+    if backend is None:
+        backend, moderation_backend = create_backends()
+    server = ChatServer(backend, moderation_backend, **kwargs)
+    app = web.Application()
+    app["server"] = server
+    app.router.add_post("/sessions/{session_id}/messages", server.post_message)
+    app.router.add_get("/sessions/{session_id}/ws", server.websocket)
+    app.router.add_delete("/sessions/{session_id}", server.delete_session)
+    app.router.add_get("/metrics", server.get_metrics)
+
+    async def backend_context(app):
+        yield
+        await server.backend.aclose()
+        if server.moderation_backend is not server.backend:
+            await server.moderation_backend.aclose()
+        # write the turns still queued by the session store
+        server.store.close()
+
+    app.cleanup_ctx.append(backend_context)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--knowledge-base", help="FAQ JSON file to retrieve context from, such as faq.json")
+    parser.add_argument("--session-store", help="SQLite database to keep the sessions in, shared by every server using it")
+    parser.add_argument("--profiles", help="JSON file of prompt profiles, such as profiles.json, instead of PROFILES_PATH")
+    parser.add_argument("--backend", choices=BACKENDS, default=LLM_BACKEND, help="where answers come from, instead of LLM_BACKEND")
+    parser.add_argument("--moderation-backend", choices=BACKENDS, help="what moderates questions, instead of MODERATION_BACKEND")
+    parser.add_argument("--api-base", help="URL of the OpenAI-compatible API, instead of LLM_API_BASE or OPENAI_API_BASE")
+    parser.add_argument("--pool-size", type=int, default=CONNECTION_POOL_SIZE, help="connections to the API kept open")
+    args = parser.parse_args()
+    knowledge_base = None
+    if args.knowledge_base:
+        from faq_index import load_knowledge_base
+
+        knowledge_base = load_knowledge_base(
+            args.knowledge_base, os.path.splitext(args.knowledge_base)[0] + ".idx"
+        )
+    store = SqliteSessionStore(args.session_store) if args.session_store else None
+    if args.profiles:
+        profiles = ProfileRegistry(args.profiles, PROFILE_DEFAULTS)
+    backend, moderation_backend = create_backends(
+        args.backend,
+        # moderated by the answering backend unless told otherwise
+        args.moderation_backend or os.getenv("MODERATION_BACKEND") or args.backend,
+        args.api_base,
+        args.pool_size,
+    )
+    web.run_app(
+        create_app(
+            backend,
+            moderation_backend,
+            knowledge_base=knowledge_base,
+            store=store,
+            profiles=profiles,
+        ),
+        host=args.host,
+        port=args.port,
+    )
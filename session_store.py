@@ -0,0 +1,220 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from history import Turn
+
+# how many sessions SqliteSessionStore.last_many reads per query
+READ_BATCH_SIZE = 100
+
+
+class SessionStore:
+    """Keeps the turns of every session in memory
+
+    Holds the latest `max_turns` turns of each session, which is all the
+    prompt ever needs. State is lost on restart and not shared between
+    processes; SqliteSessionStore is the drop-in that is.
+
+    Sessions nobody has added to or read for `idle_ttl` seconds are dropped,
+    and so are the least recently used ones beyond `max_sessions`, so a
+    long-running server doesn't keep every session it has ever seen.
+
+    Attributes:
+        evicted: How many sessions were dropped for being idle or over the limit
+    """
+
+    def __init__(self, max_turns=100, max_sessions=None, idle_ttl=None):
+        """
+        Args:
+            max_turns: The most turns to keep of each session
+            max_sessions: The most sessions to keep, or None for no limit
+            idle_ttl: Seconds an unused session is kept, or None to keep it
+        """
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.evicted = 0
+        # in order of last use, least recent first
+        self._sessions = OrderedDict()
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of sessions with at least one turn"""
+        with self._lock:
+            self._evict()
+            return len(self._sessions)
+
+    def append(self, session_id, pair):
+        """Add a turn to a session
+
+        Args:
+            session_id: The session the turn belongs to
+            pair: A (question, answer) tuple or a Turn
+        """
+        turn = pair if isinstance(pair, Turn) else Turn(*pair)
+        with self._lock:
+            self._sessions.setdefault(session_id, deque(maxlen=self.max_turns)).append(turn)
+            self._touch(session_id)
+            self._evict()
+
+    def last(self, session_id, n):
+        """Return the latest n turns of a session, oldest first"""
+        return self.last_many([session_id], n)[session_id]
+
+    def last_many(self, session_ids, n):
+        """Return the latest n turns of several sessions at once
+
+        Returns:
+            A dict from each session id to its turns, oldest first
+        """
+        with self._lock:
+            self._evict()
+            turns = {}
+            for session_id in session_ids:
+                if session_id in self._sessions:
+                    self._touch(session_id)
+                turns[session_id] = list(self._sessions.get(session_id, ()))[-n:] if n else []
+            return turns
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._used.pop(session_id, None)
+
+    def _touch(self, session_id):
+        self._sessions.move_to_end(session_id)
+        self._used[session_id] = time.monotonic()
+
+    def _evict(self):
+        if self.idle_ttl is not None:
+            # the least recently used session is first, so stop at the first fresh one
+            cutoff = time.monotonic() - self.idle_ttl
+            while self._sessions and self._used[next(iter(self._sessions))] < cutoff:
+                self._drop_oldest()
+        if self.max_sessions is not None:
+            while len(self._sessions) > self.max_sessions:
+                self._drop_oldest()
+
+    def _drop_oldest(self):
+        session_id, _ = self._sessions.popitem(last=False)
+        del self._used[session_id]
+        self.evicted += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(SessionStore):
+    """Session store in a SQLite database, shared by every process that opens it
+
+    The database is in WAL mode, so workers read while another writes.
+    Turns are queued and written in batches by a background thread, once
+    `batch_size` have been queued or `flush_interval` seconds have passed,
+    so a busy server commits once per batch rather than once per turn.
+    Queued turns are included in reads from the same process straight away.
+
+    Reads of the latest turns use an index on (session_id, id), so they
+    don't slow down as the table grows. Every turn is kept; delete a session
+    to drop it.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=0.1):
+        """
+        Args:
+            path: The database file, created if it doesn't exist
+            batch_size: How many queued turns trigger a write
+            flush_interval: The most seconds a turn waits before it is written
+        """
+        super().__init__(max_turns=None)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode this only risks the latest commits on power loss, not corruption
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY, session_id TEXT NOT NULL,"
+            " question TEXT NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        self._db.commit()
+        self._pending = []
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def __len__(self):
+        with self._lock:
+            self._write_pending()
+            return self._db.execute("SELECT COUNT(DISTINCT session_id) FROM turns").fetchone()[0]
+
+    def append(self, session_id, pair):
+        turn = pair if isinstance(pair, Turn) else Turn(*pair)
+        with self._lock:
+            self._pending.append((session_id, turn))
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def last_many(self, session_ids, n):
+        session_ids = list(session_ids)
+        turns = {session_id: [] for session_id in session_ids}
+        if not n or not session_ids:
+            return turns
+        with self._lock:
+            rows = []
+            for start in range(0, len(session_ids), READ_BATCH_SIZE):
+                batch = session_ids[start : start + READ_BATCH_SIZE]
+                # one query for the batch; each part reads only its latest n rows off the index
+                query = " UNION ALL ".join(
+                    "SELECT * FROM (SELECT id, session_id, question, answer, created FROM turns"
+                    " WHERE session_id = ? ORDER BY id DESC LIMIT ?)"
+                    for _ in batch
+                )
+                rows.extend(self._db.execute(query, [value for session_id in batch for value in (session_id, n)]))
+            for _, session_id, question, answer, created in sorted(rows):
+                turns[session_id].append(Turn(question, answer, created))
+            for session_id, turn in self._pending:
+                if session_id in turns:
+                    turns[session_id].append(turn)
+        return {session_id: session_turns[-n:] for session_id, session_turns in turns.items()}
+
+    def delete(self, session_id):
+        with self._lock:
+            self._pending = [entry for entry in self._pending if entry[0] != session_id]
+            self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def flush(self):
+        """Write the queued turns now"""
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        """Write the queued turns and close the database"""
+        self._closed = True
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+        self._db.close()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO turns (session_id, question, answer, created) VALUES (?, ?, ?, ?)",
+                [(session_id, turn.question, turn.answer, turn.created) for session_id, turn in self._pending],
+            )
+        self._pending = []
@@ -0,0 +1,132 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class FlightTimeout(TimeoutError):
+    """Raised when waiting for another caller's call takes too long"""
+
+
+class FlightAbandoned(Exception):
+    """The caller making a shared call stopped before it finished
+
+    Callers waiting for the call catch this and make the call themselves.
+    """
+
+
+class SingleFlight:
+    """Shares one call among threads asking for the same thing at once
+
+    The first caller for a key makes the call; callers with the same key
+    that come in while it is in flight wait for it and get its result, or
+    its exception. Nothing is kept once the call is done, so this caps the
+    calls during a burst of identical requests without being a cache.
+
+    Attributes:
+        calls: How many calls were made
+        shared: How many callers got the result of another caller's call
+    """
+
+    def __init__(self, timeout=None):
+        """
+        Args:
+            timeout: Seconds a caller waits for another's call before
+                FlightTimeout is raised, or None to wait as long as it takes
+        """
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def claim(self, key):
+        """Join the call in flight for a key, or start one
+
+        Returns:
+            A tuple of the Future of the call and whether the caller has to
+            make it, in which case it must settle the Future
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._flights[key] = Future()
+            self.calls += 1
+            return future, True
+
+    def settle(self, key, future, result=None, error=None):
+        """Hand the result of a call, or its exception, to the callers waiting for it"""
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def wait(self, future):
+        """Return the result of another caller's call, raising its exception if it failed"""
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            raise FlightTimeout(f"the shared call took more than {self.timeout} seconds") from None
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func, or wait for the call already in flight for the key
+
+        Returns:
+            Whatever func returns
+        """
+        while True:
+            future, leader = self.claim(key)
+            if leader:
+                break
+            try:
+                return self.wait(future)
+            except FlightAbandoned:
+                continue
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self.settle(key, future, error=error)
+            raise
+        except BaseException:
+            self.settle(key, future, error=FlightAbandoned())
+            raise
+        self.settle(key, future, result)
+        return result
+
+    def stream(self, key, func, *args, **kwargs):
+        """Like do, for a generator function yielding pieces of text
+
+        The caller making the call gets the pieces as they come; the callers
+        waiting for it get the whole text in one piece once it is done.
+
+        Yields:
+            Pieces of the text
+        """
+        while True:
+            future, leader = self.claim(key)
+            if leader:
+                break
+            try:
+                yield self.wait(future)
+                return
+            except FlightAbandoned:
+                continue
+        pieces = []
+        try:
+            for piece in func(*args, **kwargs):
+                pieces.append(piece)
+                yield piece
+        except Exception as error:
+            self.settle(key, future, error=error)
+            raise
+        except BaseException:
+            # includes the caller dropping the generator part way through
+            self.settle(key, future, error=FlightAbandoned())
+            raise
+        self.settle(key, future, "".join(pieces))
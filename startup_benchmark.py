@@ -0,0 +1,150 @@
+"""Measure how long the bot's entry points take to import
+
+Runs `python -X importtime -c "import <module>"` for each entry point a
+few times in fresh processes and reports the median total import time,
+the wall time of the process and the modules that took longest to import
+themselves. The results are appended to the same JSONL file as
+benchmark.py's, so import time can be followed across releases, and the
+script exits with status 1 if an entry point got more than
+REGRESSION_TOLERANCE slower than the last run for it.
+
+    python startup_benchmark.py --modules main,batch --repeats 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmark import REGRESSION_TOLERANCE, RESULTS_PATH, git_commit, read_results
+
+# the modules that start a chat, a batch run or the server
+ENTRY_POINTS = ("main", "test", "batch", "server")
+# fresh processes started for each entry point; the median is reported
+REPEATS = 5
+# how many of the slowest modules are reported
+SLOWEST = 5
+# imported only when an API call is made; importing any of these at
+# startup is reported
+DEFERRED_MODULES = ("openai", "numpy", "tiktoken")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(output):
+    """Read the lines -X importtime writes to stderr
+
+    Returns:
+        A list of (module, self microseconds, cumulative microseconds, depth)
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def time_import(module):
+    """Import a module in a fresh interpreter
+
+    Returns:
+        The (module, self, cumulative, depth) tuples and the process's wall time in seconds
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{process.stderr[-2000:]}")
+    return parse_importtime(process.stderr), seconds
+
+
+def measure(module, repeats=REPEATS):
+    """Return the startup result for an entry point"""
+    totals, walls, self_times = [], [], {}
+    imported = set()
+    for _ in range(repeats):
+        imports, seconds = time_import(module)
+        # the modules imported directly by the interpreter or the -c line
+        totals.append(sum(cumulative for _, _, cumulative, depth in imports if depth == 0))
+        walls.append(seconds)
+        for name, self_us, _, _ in imports:
+            self_times.setdefault(name, []).append(self_us)
+            imported.add(name)
+    slowest = sorted(self_times, key=lambda name: statistics.median(self_times[name]), reverse=True)[:SLOWEST]
+    return {
+        "scenario": "startup",
+        "module": module,
+        "repeats": repeats,
+        "import_ms": round(statistics.median(totals) / 1000, 1),
+        "wall_ms": round(statistics.median(walls) * 1000, 1),
+        "modules": len(imported),
+        "slowest": {name: round(statistics.median(self_times[name]) / 1000, 1) for name in slowest},
+        "deferred_imported": [name for name in DEFERRED_MODULES if name in imported],
+    }
+
+
+def find_regressions(result, previous, tolerance=REGRESSION_TOLERANCE):
+    """Compare a result with the last one for the same entry point
+
+    Returns:
+        A list of messages, empty if nothing got worse by more than `tolerance`
+    """
+    baseline = None
+    for record in reversed(previous):
+        if record.get("scenario") == "startup" and record.get("module") == result["module"]:
+            baseline = record
+            break
+    regressions = [f"imports {name} at startup" for name in result["deferred_imported"]]
+    if baseline is not None and result["import_ms"] > baseline["import_ms"] * (1 + tolerance):
+        regressions.append(f"import {baseline['import_ms']}ms -> {result['import_ms']}ms")
+    return regressions
+
+
+def run(modules, repeats=REPEATS, results_path=RESULTS_PATH):
+    """Measure every entry point and store the results
+
+    Returns:
+        The number of results that regressed
+    """
+    previous = read_results(results_path)
+    commit = git_commit()
+    regressed = 0
+    print(f"{'module':<10}{'import ms':>11}{'wall ms':>9}{'modules':>9}  slowest")
+    with open(results_path, "a", encoding="utf-8") as output:
+        for module in modules:
+            result = measure(module, repeats)
+            result.update(time=time.time(), commit=commit)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+            regressions = find_regressions(result, previous)
+            regressed += bool(regressions)
+            slowest = ", ".join(f"{name} {ms}" for name, ms in result["slowest"].items())
+            print(
+                f"{module:<10}{result['import_ms']:>11}{result['wall_ms']:>9}{result['modules']:>9}  {slowest}"
+                + (f"  REGRESSION: {', '.join(regressions)}" if regressions else "")
+            )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", default=",".join(ENTRY_POINTS), help="comma separated, from " + ", ".join(ENTRY_POINTS))
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="fresh processes per module")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL file to append the results to")
+    args = parser.parse_args()
+    modules = args.modules.split(",")
+    for module in modules:
+        if module not in ENTRY_POINTS:
+            parser.error(f"unknown module {module!r}")
+    sys.exit(1 if run(modules, args.repeats, args.results) else 0)
@@ -0,0 +1,65 @@
+from prompt import pair_tokens
+
+SUMMARY_INSTRUCTIONS = """You summarize customer service conversations.
+Fold the new turns into the summary so far. Keep every fact the assistant may
+need later, such as names, order and tracking numbers, dates, products and
+what has already been tried or promised. Reply with the updated summary only."""
+
+
+def format_turns(turns):
+    """Write turns out as a transcript"""
+    return "\n".join(
+        f"Customer: {question}\nAssistant: {answer}" for question, answer in turns
+    )
+
+
+class RollingSummary:
+    """Running summary of the turns that no longer fit in the prompt
+
+    Evicted turns are collected as they are and only folded into the summary
+    once they add up to `threshold` tokens, so the summarizer is called once
+    for many turns rather than on every turn.
+    """
+
+    def __init__(self, summarize, threshold=400, errors=(Exception,)):
+        """
+        Args:
+            summarize: Callable taking the summary so far and a list of turns and
+                returning the updated summary
+            threshold: How many tokens of turns to collect before summarizing
+            errors: Exceptions from summarize that leave the turns to try again later
+        """
+        self.summarize = summarize
+        self.threshold = threshold
+        self.errors = errors
+        self.text = ""
+        self.pending = []
+        self.pending_tokens = 0
+
+    def add(self, turn):
+        """Collect an evicted turn, summarizing once enough have been collected"""
+        self.pending.append(tuple(turn))
+        self.pending_tokens += pair_tokens(tuple(turn))
+        if self.pending_tokens >= self.threshold:
+            self.refresh()
+
+    def refresh(self):
+        """Fold the collected turns into the summary"""
+        if not self.pending:
+            return
+        try:
+            self.text = self.summarize(self.text, self.pending)
+        except self.errors:
+            # keep the turns and try again after the next eviction
+            return
+        self.pending = []
+        self.pending_tokens = 0
+
+    def message(self):
+        """Return the content of the summary message, or None if there is nothing to say"""
+        parts = []
+        if self.text:
+            parts.append(f"Summary of the conversation so far:\n{self.text}")
+        if self.pending:
+            parts.append(f"Earlier in the conversation:\n{format_turns(self.pending)}")
+        return "\n\n".join(parts) or None
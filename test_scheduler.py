@@ -0,0 +1,158 @@
+"""Drive the scheduler against fake_openai.py with injected failures
+
+    python -m unittest test_scheduler
+"""
+import asyncio
+import time
+import unittest
+
+from aiohttp import web
+
+import fake_openai
+from backends import HTTPBackend
+from benchmark import FakeServer
+from openai_client import RateLimitError, RetryableAPIError
+from scheduler import CircuitBreaker, CircuitOpenError, Scheduler
+
+
+class ServerErrors(fake_openai.Behaviour):
+    """Answers every request with a 500 while `failing` is set"""
+
+    failing = True
+
+    def error(self):
+        self.requests += 1
+        if not self.failing:
+            return None
+        self.errors += 1
+        return web.json_response({"error": {"message": "The server had an error"}}, status=500)
+
+
+class RateLimits(fake_openai.Behaviour):
+    """Answers every request with a 429"""
+
+    def error(self):
+        self.requests += 1
+        self.errors += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached"}}, status=429, headers={"Retry-After": "0"}
+        )
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+
+    def backend(self, behaviour):
+        """Start a fake API with the given behaviour and return an HTTPBackend for it"""
+        server = FakeServer(behaviour)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        backend = HTTPBackend(server.url)
+        self.addCleanup(backend.close)
+        return backend
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault("breaker", CircuitBreaker(failure_threshold=100))
+        return Scheduler(
+            retryable=(RetryableAPIError,),
+            rate_limited=(RateLimitError,),
+            backoff_base=0.01,
+            sleep=self.sleeps.append,
+            **kwargs,
+        )
+
+    def test_retries_injected_failures(self):
+        behaviour = fake_openai.Behaviour(error_rate=0.5, seed=1)
+        backend = self.backend(behaviour)
+        scheduler = self.scheduler(max_retries=20)
+        for i in range(20):
+            self.assertFalse(scheduler.call(backend.moderate, f"question {i}")["flagged"])
+        completion = scheduler.call(backend.complete, [{"role": "user", "content": "hi"}], model="fake")
+        self.assertIn("hi", completion.text)
+        self.assertGreater(behaviour.errors, 0)
+        self.assertEqual(scheduler.retries, behaviour.errors)
+        self.assertEqual(len(self.sleeps), behaviour.errors)
+        self.assertEqual(scheduler.breaker.state, "closed")
+
+    def test_retries_injected_failures_async(self):
+        behaviour = fake_openai.Behaviour(error_rate=0.5, seed=2)
+        backend = self.backend(behaviour)
+        scheduler = self.scheduler(max_retries=20)
+
+        async def ask():
+            try:
+                return [await scheduler.call_async(backend.amoderate, f"question {i}") for i in range(10)]
+            finally:
+                await backend.aclose()
+
+        self.assertEqual(len(asyncio.run(ask())), 10)
+        self.assertGreater(behaviour.errors, 0)
+        self.assertEqual(scheduler.retries, behaviour.errors)
+
+    def test_backoff_grows_and_honours_retry_after(self):
+        scheduler = self.scheduler(max_retries=20)
+        scheduler.backoff_base, scheduler.backoff_max = 1, 8
+        error = RetryableAPIError("500: down")
+        for attempt in range(6):
+            self.assertLessEqual(scheduler.backoff(attempt, error), min(8, 2 ** attempt))
+        limited = RateLimitError("429: busy", {"Retry-After": "30"})
+        self.assertGreaterEqual(scheduler.backoff(0, limited), 30)
+
+    def test_gives_up_after_max_retries(self):
+        behaviour = ServerErrors()
+        backend = self.backend(behaviour)
+        scheduler = self.scheduler(max_retries=3)
+        with self.assertRaises(RetryableAPIError):
+            scheduler.call(backend.moderate, "question")
+        self.assertEqual(behaviour.requests, 4)
+        self.assertEqual(len(self.sleeps), 3)
+
+    def test_circuit_opens_on_server_errors(self):
+        behaviour = ServerErrors()
+        backend = self.backend(behaviour)
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        scheduler = self.scheduler(max_retries=10, breaker=breaker, circuit_wait=0)
+        with self.assertRaises(CircuitOpenError):
+            scheduler.call(backend.moderate, "question")
+        self.assertEqual(behaviour.requests, 3)
+        self.assertEqual(breaker.state, "open")
+        # an open circuit fails calls without reaching the API
+        with self.assertRaises(CircuitOpenError):
+            scheduler.call(backend.moderate, "question")
+        self.assertEqual(behaviour.requests, 3)
+
+    def test_trial_call_closes_circuit(self):
+        behaviour = ServerErrors()
+        backend = self.backend(behaviour)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        scheduler = self.scheduler(max_retries=5, breaker=breaker, circuit_wait=0)
+        with self.assertRaises(CircuitOpenError):
+            scheduler.call(backend.moderate, "question")
+        behaviour.failing = False
+        time.sleep(0.2)
+        self.assertEqual(breaker.state, "half-open")
+        self.assertFalse(scheduler.call(backend.moderate, "question")["flagged"])
+        self.assertEqual(breaker.state, "closed")
+
+    def test_rate_limits_dont_open_circuit(self):
+        behaviour = RateLimits()
+        backend = self.backend(behaviour)
+        breaker = CircuitBreaker(failure_threshold=2)
+        scheduler = self.scheduler(max_retries=4, breaker=breaker)
+        with self.assertRaises(RateLimitError):
+            scheduler.call(backend.moderate, "question")
+        self.assertEqual(behaviour.requests, 5)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_moderation_times_out(self):
+        backend = self.backend(fake_openai.Behaviour(latency=2))
+        scheduler = self.scheduler(max_retries=0, timeout=0.2)
+        start = time.monotonic()
+        with self.assertRaises(RetryableAPIError):
+            scheduler.call(backend.moderate, "question")
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
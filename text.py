@@ -0,0 +1,36 @@
+import re
+
+# character n-gram sizes used to vectorize questions
+NGRAM_RANGE = (3, 5)
+
+
+def normalize(text):
+    """Normalize text so that trivially different questions compare equal
+
+    Args:
+        text: The text to normalize
+
+    Returns:
+        The lowercased text with punctuation removed and whitespace collapsed
+    """
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def char_ngrams(text, ngram_range=NGRAM_RANGE):
+    """Split normalized text into overlapping character n-grams
+
+    Args:
+        text: The normalized text
+        ngram_range: The smallest and largest n-gram size
+
+    Returns:
+        A list of n-grams, padded with spaces so word boundaries count
+    """
+    text = f" {text} "
+    low, high = ngram_range
+    return [
+        text[i : i + n]
+        for n in range(low, high + 1)
+        for i in range(len(text) - n + 1)
+    ]
@@ -0,0 +1,189 @@
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+# how many turns may wait to be written; turns recorded while it is full are dropped
+MAX_QUEUED = 10000
+# how many queued turns trigger a write, and the most seconds a turn waits for one
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 1.0
+# the compressed size a file grows to before it is rotated, and how many rotated files are kept
+MAX_BYTES = 64 * 1024 * 1024
+BACKUP_COUNT = 10
+
+
+def transcript_turn(session_id, question, answer=None, moderation=None, latency=None, usage=None, **fields):
+    """Make the record of one turn of a chat
+
+    Args:
+        session_id: The chat the turn belongs to
+        question: The question that was asked
+        answer: The answer, or None if the question was flagged or failed
+        moderation: The moderation errors, an empty list if the question passed,
+            or None if it wasn't moderated, such as an FAQ answer
+        latency: Seconds from the question to the end of the answer
+        usage: The prompt_tokens and completion_tokens spent on the answer
+        **fields: Anything else to record, such as the profile or an error
+
+    Returns:
+        A dict that is written as one line of JSON
+    """
+    return {
+        # random like uuid4, without importing uuid at startup
+        "turn_id": os.urandom(16).hex(),
+        "session_id": session_id,
+        "created": time.time(),
+        "question": question,
+        "answer": answer,
+        "moderation": None if moderation is None else {"flagged": bool(moderation), "errors": moderation},
+        "latency": latency,
+        "usage": usage or {},
+        **fields,
+    }
+
+
+class TranscriptSink:
+    """Writes chat turns to rotating, gzip-compressed JSONL files
+
+    Recording a turn only queues it; a background thread writes the queue
+    in batches, once `batch_size` turns have been queued or `flush_interval`
+    seconds have passed, so the chat never waits for the disk. At most
+    `max_queued` turns are held in memory; when the disk can't keep up,
+    further turns are dropped and counted rather than slowing the chat down.
+
+    Each batch is appended as a gzip member of its own, so the files read
+    back as one stream with gzip.open or zcat, and a crash only loses the
+    turns not written yet. Once the file is `max_bytes` long it is renamed
+    to transcripts.1.jsonl.gz, the older ones shifting up to
+    `backup_count`, and a new file is started.
+
+    Attributes:
+        written: How many turns were written
+        dropped: How many turns were dropped because the queue was full
+        invalid: How many turns were dropped because they couldn't be serialized
+        errors: How many batches failed to be written
+    """
+
+    def __init__(
+        self,
+        path,
+        max_queued=MAX_QUEUED,
+        batch_size=BATCH_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+        max_bytes=MAX_BYTES,
+        backup_count=BACKUP_COUNT,
+    ):
+        """
+        Args:
+            path: The file to write, such as transcripts.jsonl.gz
+            max_queued: The most turns waiting to be written
+            batch_size: How many queued turns trigger a write
+            flush_interval: The most seconds a turn waits before it is written
+            max_bytes: The size the file grows to before it is rotated
+            backup_count: How many rotated files are kept
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.written = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.errors = 0
+        self._queue = queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def __len__(self):
+        """Return the number of turns waiting to be written"""
+        return self._queue.qsize()
+
+    def record(self, turn):
+        """Queue a turn to be written
+
+        Args:
+            turn: A dict that can be serialized as JSON, see transcript_turn
+
+        Returns:
+            False if the queue was full and the turn was dropped
+        """
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Write the queued turns now"""
+        with self._lock:
+            turns = []
+            while True:
+                try:
+                    turns.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for turn in turns:
+                try:
+                    lines.append((json.dumps(turn, ensure_ascii=False) + "\n").encode("utf-8"))
+                except (TypeError, ValueError, RecursionError):
+                    # a turn that isn't JSON costs itself, not its batch or the flusher
+                    self.invalid += 1
+            if not lines:
+                return
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+                with gzip.open(self.path, "ab") as file:
+                    file.write(b"".join(lines))
+            except OSError:
+                # a full or missing disk costs this batch, not the chat
+                self.errors += 1
+                return
+            self.written += len(lines)
+
+    def close(self):
+        """Write the queued turns and stop the background thread"""
+        self._closed = True
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _rotate(self):
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self.rotated_path(number)):
+                os.replace(self.rotated_path(number), self.rotated_path(number + 1))
+        os.replace(self.path, self.rotated_path(1))
+
+    def rotated_path(self, number):
+        """Return the name of a rotated file, with the number before the extensions"""
+        directory, name = os.path.split(self.path)
+        stem, dot, extensions = name.partition(".")
+        return os.path.join(directory, f"{stem}.{number}{dot}{extensions}")
+
+    def collect_metrics(self):
+        """Report the turns written and dropped, for metrics.Registry.collector"""
+        yield "chatbot_transcript_turns_total", "counter", "Chat turns written to the transcripts", {}, self.written
+        yield "chatbot_transcript_dropped_total", "counter", "Chat turns dropped because the transcript queue was full", {}, self.dropped
+        yield "chatbot_transcript_invalid_total", "counter", "Chat turns dropped because they couldn't be serialized as JSON", {}, self.invalid
+        yield "chatbot_transcript_errors_total", "counter", "Transcript batches that failed to be written", {}, self.errors
+        yield "chatbot_transcript_queued", "gauge", "Chat turns waiting to be written to the transcripts", {}, len(self)